@@ -4,6 +4,160 @@ import time
 import os
 import json
 import importlib
+import importlib.util
+import threading
+import queue
+
+
+def _load_egl_plugin(physics_client):
+    # Returns the id of the EGL renderer plugin (for rendering with OpenGL
+    # but without a display), or None if it cannot be loaded
+    spec = importlib.util.find_spec('eglRenderer')
+    if spec is None:
+        plugin_id = pybullet.loadPlugin('eglRendererPlugin', physicsClientId=physics_client)
+    else:
+        plugin_id = pybullet.loadPlugin(spec.origin, '_eglRendererPlugin', physicsClientId=physics_client)
+    if plugin_id < 0:
+        return None
+    return plugin_id
+
+
+def _get_renderer(renderer, display, physics_client):
+    # Returns the name of the renderer used for snapshots, the flag that is
+    # passed to getCameraImage, and the id of the EGL plugin (None if it was
+    # not loaded), given one of these names:
+    #
+    #  'opengl': OpenGL in the GUI (needs display=True)
+    #  'egl': OpenGL without a display (needs display=False and EGL)
+    #  'tiny': TinyRenderer (software, works everywhere)
+    #  'auto': 'opengl' with a display, otherwise 'egl' if EGL can be
+    #          loaded, otherwise 'tiny'
+    #
+    if renderer not in ['auto', 'opengl', 'egl', 'tiny']:
+        raise Exception(f'renderer must be "auto", "opengl", "egl", or "tiny" (not "{renderer}")')
+    if (renderer == 'opengl') or ((renderer == 'auto') and display):
+        if not display:
+            raise Exception('the "opengl" renderer needs display=True (use "egl" or "tiny")')
+        return 'opengl', pybullet.ER_BULLET_HARDWARE_OPENGL, None
+    if renderer in ['egl', 'auto']:
+        if display:
+            raise Exception('the "egl" renderer needs display=False (use "opengl")')
+        plugin_id = _load_egl_plugin(physics_client)
+        if plugin_id is not None:
+            return 'egl', pybullet.ER_BULLET_HARDWARE_OPENGL, plugin_id
+        if renderer == 'egl':
+            raise Exception('could not load the EGL renderer plugin (use "tiny")')
+    return 'tiny', pybullet.ER_TINY_RENDERER, None
+
+
+class _VideoWriter:
+    # Writes frames to a video file - frames wait in a queue of bounded size
+    # and are encoded by a background thread, so the simulation only has to
+    # wait for the encoder when the queue is full. If fps is given, only
+    # every k-th time step is added to the video, with k chosen so that
+    # the video still plays in real time.
+
+    def __init__(self, filename, dt, fps=None, queue_size=32):
+        imageio = importlib.import_module('imageio')
+        if fps is None:
+            self.frame_interval = 1
+        else:
+            self.frame_interval = max(1, int(round(1 / (dt * fps))))
+        self.fps = 1 / (dt * self.frame_interval)
+        self.writer = imageio.get_writer(filename,
+                                         format='FFMPEG',
+                                         mode='I',
+                                         fps=self.fps)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.num_frames = 0
+        self.num_waits = 0
+        self.wait_time = 0.
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def _encode(self):
+        while True:
+            rgba = self.queue.get()
+            if rgba is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.writer.append_data(rgba)
+            except Exception as err:
+                self.error = err
+
+    def add(self, rgba):
+        if self.error is not None:
+            raise self.error
+        self.num_frames += 1
+        try:
+            self.queue.put_nowait(rgba)
+        except queue.Full:
+            start_time = time.time()
+            self.queue.put(rgba)
+            self.num_waits += 1
+            self.wait_time += time.time() - start_time
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+        return {
+            'num_frames': self.num_frames,
+            'num_waits': self.num_waits,
+            'wait_time': self.wait_time,
+        }
+
+
+class _Pacer:
+    # Keeps a simulation with a display at a real-time factor (simulated time
+    # divided by wall-clock time, or None to run as fast as possible), and
+    # says when to refresh the display - at most fps times per second of
+    # wall-clock time, however fast time is simulated. A refresh that is
+    # missed because time steps took too long is counted as dropped.
+
+    def __init__(self, dt, real_time_factor=1., fps=30., time_step=0):
+        self.dt = dt
+        self.real_time_factor = real_time_factor
+        self.frame_time = 1 / fps
+        self.start_time = time.perf_counter()
+        self.start_time_step = time_step
+        self.next_frame_time = self.start_time
+        self.num_frames = 0
+        self.num_dropped_frames = 0
+
+    def wait(self, time_step):
+        # Wait until the end of the given time step
+        if self.real_time_factor is None:
+            return
+        t = self.start_time + (self.dt * (time_step + 1 - self.start_time_step) / self.real_time_factor)
+        time_to_wait = t - time.perf_counter()
+        while time_to_wait > 0:
+            time.sleep(0.9 * time_to_wait)
+            time_to_wait = t - time.perf_counter()
+
+    def is_frame_due(self):
+        now = time.perf_counter()
+        if now < self.next_frame_time:
+            return False
+        num_missed = int((now - self.next_frame_time) / self.frame_time)
+        self.num_frames += 1
+        self.num_dropped_frames += num_missed
+        self.next_frame_time += (num_missed + 1) * self.frame_time
+        return True
+
+    def report(self, time_step):
+        elapsed_time = time.perf_counter() - self.start_time
+        return {
+            'real_time_factor': (((time_step - self.start_time_step) * self.dt) / elapsed_time) if elapsed_time > 0 else None,
+            'target_real_time_factor': self.real_time_factor,
+            'num_frames': self.num_frames,
+            'num_dropped_frames': self.num_dropped_frames,
+        }
 
 
 class Simulator:
@@ -13,6 +167,8 @@ class Simulator:
                 seed=None,
                 width=640,
                 height=480,
+                renderer='auto',
+                shadow=True,
                 damping=0.,
                 tau_max=1.,
                 station_velocity=-0.5,
@@ -23,13 +179,27 @@ class Simulator:
         # Random number generator
         self.rng = np.random.default_rng(seed)
 
-        # Size of display
+        # Size of display (and of snapshots, unless given)
         self.width = width
         self.height = height
+        self.snapshot_width = width
+        self.snapshot_height = height
+
+        # Renderer and shadows for snapshots (see _get_renderer_flag)
+        self.renderer = renderer
+        self.renderer_flag = None
+        self.egl_plugin = None
+        self.shadow = shadow
 
         # Time step
         self.dt = dt
 
+        # Real-time factor and rate of camera updates (see set_real_time_factor)
+        self.real_time_factor = 1.
+        self.display_fps = 30.
+        self.pacer = None
+        self.pacing_report = None
+
         # Which station model to use
         self.bumpy = bumpy
         if self.bumpy:
@@ -46,7 +216,9 @@ class Simulator:
         self.wheel_radius = 0.325
         self.wheel_base = 0.7
 
-        # Connect to and configure pybullet
+        # Connect to and configure pybullet (this simulator uses the default
+        # physics client)
+        self.physics_client = 0
         self.display = display
         if self.display:
             pybullet.connect(pybullet.GUI, options=f'--width={width} --height={height}')
@@ -297,7 +469,20 @@ class Simulator:
         self._update_camera()
         self._update_display()
     
-    def run(self, controller, max_time=5.0, data_filename=None, video_filename=None, print_debug=False):
+    def set_real_time_factor(self, real_time_factor=1., fps=30.):
+        """
+        with a display, runs the simulation at real_time_factor times real
+        time (from 0.25 to 20, or None for as fast as possible) and moves the
+        camera at most fps times per second - see pacing_report after run
+        """
+        if (real_time_factor is not None) and not (0.25 <= real_time_factor <= 20.):
+            raise Exception(f'real_time_factor must be between 0.25 and 20, or None (not {real_time_factor})')
+        if fps <= 0:
+            raise Exception(f'fps must be positive (not {fps})')
+        self.real_time_factor = real_time_factor
+        self.display_fps = fps
+
+    def run(self, controller, max_time=5.0, data_filename=None, video_filename=None, print_debug=False, video_fps=None, video_width=None, video_height=None):
         self.data = {
             't': [],
             'lateral_error': [],
@@ -323,22 +508,15 @@ class Simulator:
         self.time_step = 0
         self.max_time_steps = int(max_time / self.dt)
         self.start_time = time.time()
+        self.pacer = _Pacer(self.dt, self.real_time_factor, self.display_fps, self.time_step)
 
         if video_filename is not None:
-            # Import imageio
-            imageio = importlib.import_module('imageio')
-
-            # Open video
-            fps = int(1 / self.dt)
-            print(f'Creating a video with name {video_filename} and fps {fps}')
-            w = imageio.get_writer(video_filename,
-                                   format='FFMPEG',
-                                   mode='I',
-                                   fps=fps)
+            # Open video (see _VideoWriter)
+            video = _VideoWriter(video_filename, self.dt, fps=video_fps)
+            print(f'Creating a video with name {video_filename} and fps {video.fps:g}')
 
             # Add first frame to video
-            rgba = self.snapshot()
-            w.append_data(rgba)
+            video.add(self.snapshot(video_width, video_height))
 
         while True:
             all_done = self.step(controller)
@@ -347,9 +525,9 @@ class Simulator:
                 if self.time_step % 100 == 0:
                     print(f' {self.time_step} / {self.max_time_steps}')
 
-                # Add frame to video
-                rgba = self.snapshot()
-                w.append_data(rgba)
+                # Add frame to video (every k-th time step)
+                if self.time_step % video.frame_interval == 0:
+                    video.add(self.snapshot(video_width, video_height))
 
             if all_done:
                 break
@@ -358,8 +536,11 @@ class Simulator:
                 break
 
         if video_filename is not None:
-            # Close video
-            w.close()
+            # Close video (after all frames have been encoded) and report if
+            # the simulation had to wait for the encoder
+            self.video_report = video.close()
+            if self.video_report['num_waits'] > 0:
+                print(f'The simulation waited {self.video_report["wait_time"]:.2f} seconds for the video encoder ({self.video_report["num_waits"]} of {self.video_report["num_frames"]} frames)')
 
         if data_filename is not None:
             with open(data_filename, 'w') as f:
@@ -373,6 +554,11 @@ class Simulator:
         if (elapsed_time > 0) and print_debug:
             print(f'Simulated {elapsed_time_steps} time steps in {elapsed_time:.4f} seconds ({(elapsed_time_steps / elapsed_time):.4f} time steps per second)')
 
+        # Report the real-time factor and the number of dropped frames (see _Pacer)
+        self.pacing_report = self.pacer.report(self.time_step)
+        if self.display and print_debug:
+            print(f'Ran at {self.pacing_report["real_time_factor"]:.2f} times real time (target {self.real_time_factor}), moved the camera {self.pacing_report["num_frames"]} times ({self.pacing_report["num_dropped_frames"]} dropped)')
+
         # convert lists to numpy arrays
         data = self.data.copy()
         for key in data.keys():
@@ -447,13 +633,12 @@ class Simulator:
                 val = val.flatten().tolist()
             self.data[key].append(val)
 
-        # Try to stay real-time
+        # Try to stay at the chosen real-time factor (see _Pacer)
         if self.display:
-            t = self.start_time + (self.dt * (self.time_step + 1))
-            time_to_wait = t - time.time()
-            while time_to_wait > 0:
-                time.sleep(0.9 * time_to_wait)
-                time_to_wait = t - time.time()
+            if self.pacer is None:
+                # step was called outside of run
+                self.pacer = _Pacer(self.dt, self.real_time_factor, self.display_fps, self.time_step)
+            self.pacer.wait(self.time_step)
 
         # Take a simulation step
         pybullet.stepSimulation()
@@ -461,12 +646,26 @@ class Simulator:
         # Increment time step
         self.time_step += 1
 
-        # Update camera
-        self._update_camera()
+        # Update camera (at most display_fps times per second)
+        if self.display and self.pacer.is_frame_due():
+            self._update_camera()
 
         return all_done
 
-    def snapshot(self):
+    def _get_renderer_flag(self):
+        # Choose the renderer the first time a snapshot is taken (so the EGL
+        # plugin is only loaded if it is needed) - see _get_renderer
+        if self.renderer_flag is None:
+            self.renderer, self.renderer_flag, self.egl_plugin = _get_renderer(self.renderer, self.display, self.physics_client)
+        return self.renderer_flag
+
+    def snapshot(self, width=None, height=None):
+        # size of image, unless given (see __init__)
+        if width is None:
+            width = self.snapshot_width
+        if height is None:
+            height = self.snapshot_height
+
         link_states = pybullet.getLinkStates(self.robot_id, self.joint_ids)
         pl = np.array(link_states[0][0])
         pr = np.array(link_states[1][0])
@@ -487,14 +686,14 @@ class Simulator:
         else:
             raise Exception('invalid camera view')
         
-        aspect = self.width / self.height
+        aspect = width / height
         projection_matrix = pybullet.computeProjectionMatrixFOV(fov=90, aspect=aspect, nearVal=0.01, farVal=100.0)
         im = pybullet.getCameraImage(
-            self.width, self.height,
+            width, height,
             viewMatrix=view_matrix,
             projectionMatrix=projection_matrix,
-            renderer=pybullet.ER_BULLET_HARDWARE_OPENGL,
-            shadow=1,
+            renderer=self._get_renderer_flag(),
+            shadow=int(self.shadow),
             lightDirection=[10., 10., 10.],
         )
         rgba = im[2]
@@ -3,15 +3,815 @@ import pybullet
 import time
 import os
 from scipy import linalg
+from scipy import spatial
 import importlib
+import importlib.util
+import threading
+import queue
 import pkgutil
 import traceback
 import contextlib
-import io
+import sys
+import math
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+import hashlib
+import json
+import struct
+import pickle
+import copy
+import uuid
+
+
+def _get_matrices_from_quaternions(q):
+    # Rotation matrix for each row [x, y, z, w] of q (same as what is
+    # returned by pybullet.getMatrixFromQuaternion)
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    R = np.empty((q.shape[0], 3, 3))
+    R[:, 0, 0] = 1. - 2. * (y * y + z * z)
+    R[:, 0, 1] = 2. * (x * y - z * w)
+    R[:, 0, 2] = 2. * (x * z + y * w)
+    R[:, 1, 0] = 2. * (x * y + z * w)
+    R[:, 1, 1] = 1. - 2. * (x * x + z * z)
+    R[:, 1, 2] = 2. * (y * z - x * w)
+    R[:, 2, 0] = 2. * (x * z - y * w)
+    R[:, 2, 1] = 2. * (y * z + x * w)
+    R[:, 2, 2] = 1. - 2. * (x * x + y * y)
+    return R
+
+
+def _get_eulers_from_quaternions(q):
+    # Roll, pitch, yaw for each row [x, y, z, w] of q (same as what is
+    # returned by pybullet.getEulerFromQuaternion)
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    rpy = np.empty((q.shape[0], 3))
+    sarg = -2. * (x * z - w * y)
+    rpy[:, 0] = np.arctan2(2. * (y * z + w * x), w * w - x * x - y * y + z * z)
+    rpy[:, 1] = np.arcsin(np.clip(sarg, -1., 1.))
+    rpy[:, 2] = np.arctan2(2. * (x * y + w * z), w * w + x * x - y * y - z * z)
+    # Handle gimbal lock
+    i = (sarg <= -0.99999)
+    rpy[i, 0] = 0.
+    rpy[i, 1] = -0.5 * np.pi
+    rpy[i, 2] = 2. * np.arctan2(x[i], -y[i])
+    i = (sarg >= 0.99999)
+    rpy[i, 0] = 0.
+    rpy[i, 1] = 0.5 * np.pi
+    rpy[i, 2] = 2. * np.arctan2(-x[i], y[i])
+    return rpy
+
+
+def _get_matrices_from_eulers(rpy):
+    # Rotation matrix R = Rz(yaw) Ry(pitch) Rx(roll) for each row
+    # [roll, pitch, yaw] of rpy (the same convention as pybullet)
+    c = np.cos(rpy)
+    s = np.sin(rpy)
+    c_r, c_p, c_y = c[:, 0], c[:, 1], c[:, 2]
+    s_r, s_p, s_y = s[:, 0], s[:, 1], s[:, 2]
+    R = np.empty((rpy.shape[0], 3, 3))
+    R[:, 0, 0] = c_y * c_p
+    R[:, 0, 1] = c_y * s_p * s_r - s_y * c_r
+    R[:, 0, 2] = c_y * s_p * c_r + s_y * s_r
+    R[:, 1, 0] = s_y * c_p
+    R[:, 1, 1] = s_y * s_p * s_r + c_y * c_r
+    R[:, 1, 2] = s_y * s_p * c_r - c_y * s_r
+    R[:, 2, 0] = -s_p
+    R[:, 2, 1] = c_p * s_r
+    R[:, 2, 2] = c_p * c_r
+    return R
+
+
+def _get_quaternions_from_eulers(rpy):
+    # Quaternion [x, y, z, w] for each row [roll, pitch, yaw] of rpy
+    c = np.cos(0.5 * rpy)
+    s = np.sin(0.5 * rpy)
+    c_r, c_p, c_y = c[:, 0], c[:, 1], c[:, 2]
+    s_r, s_p, s_y = s[:, 0], s[:, 1], s[:, 2]
+    return np.column_stack([
+        s_r * c_p * c_y - c_r * s_p * s_y,
+        c_r * s_p * c_y + s_r * c_p * s_y,
+        c_r * c_p * s_y - s_r * s_p * c_y,
+        c_r * c_p * c_y + s_r * s_p * s_y,
+    ])
+
+
+def _load_egl_plugin(physics_client):
+    # Returns the id of the EGL renderer plugin (for rendering with OpenGL
+    # but without a display), or None if it cannot be loaded
+    spec = importlib.util.find_spec('eglRenderer')
+    if spec is None:
+        plugin_id = pybullet.loadPlugin('eglRendererPlugin', physicsClientId=physics_client)
+    else:
+        plugin_id = pybullet.loadPlugin(spec.origin, '_eglRendererPlugin', physicsClientId=physics_client)
+    if plugin_id < 0:
+        return None
+    return plugin_id
+
+
+def _get_renderer(renderer, display, physics_client):
+    # Returns the name of the renderer used for snapshots, the flag that is
+    # passed to getCameraImage, and the id of the EGL plugin (None if it was
+    # not loaded), given one of these names:
+    #
+    #  'opengl': OpenGL in the GUI (needs display=True)
+    #  'egl': OpenGL without a display (needs display=False and EGL)
+    #  'tiny': TinyRenderer (software, works everywhere)
+    #  'auto': 'opengl' with a display, otherwise 'egl' if EGL can be
+    #          loaded, otherwise 'tiny'
+    #
+    if renderer not in ['auto', 'opengl', 'egl', 'tiny']:
+        raise Exception(f'renderer must be "auto", "opengl", "egl", or "tiny" (not "{renderer}")')
+    if (renderer == 'opengl') or ((renderer == 'auto') and display):
+        if not display:
+            raise Exception('the "opengl" renderer needs display=True (use "egl" or "tiny")')
+        return 'opengl', pybullet.ER_BULLET_HARDWARE_OPENGL, None
+    if renderer in ['egl', 'auto']:
+        if display:
+            raise Exception('the "egl" renderer needs display=False (use "opengl")')
+        plugin_id = _load_egl_plugin(physics_client)
+        if plugin_id is not None:
+            return 'egl', pybullet.ER_BULLET_HARDWARE_OPENGL, plugin_id
+        if renderer == 'egl':
+            raise Exception('could not load the EGL renderer plugin (use "tiny")')
+    return 'tiny', pybullet.ER_TINY_RENDERER, None
+
+
+def _get_neighbors(p, num_neighbors=None, radius=None, active=None):
+    # Returns the index of the (at most) num_neighbors other drones that are
+    # within radius of each drone, nearest first, as an n x m array that is
+    # padded with n, and the number of neighbors of each drone - these come
+    # from one query of a kd-tree with the position p of all drones that are
+    # active (all by default) and have a finite position, and only these
+    # drones have (or are) neighbors
+    n = p.shape[0]
+    k = n - 1 if num_neighbors is None else min(num_neighbors, n - 1)
+    neighbors = np.full((n, max(k, 0)), n)
+    valid = np.all(np.isfinite(p), axis=1)
+    if active is not None:
+        valid &= active
+    index = np.flatnonzero(valid)
+    m = len(index)
+    k = min(k, m - 1)
+    if k <= 0:
+        return neighbors, np.zeros(n, dtype=int)
+    tree = spatial.cKDTree(p[index])
+    dist, i = tree.query(p[index], k=(k + 1), distance_upper_bound=(np.inf if radius is None else radius))
+    i = np.reshape(i, (m, k + 1))
+    keep = (i != np.arange(m)[:, np.newaxis])
+    keep[np.all(keep, axis=1), -1] = False
+    i = np.reshape(i[keep], (m, k))
+    neighbors[index, :k] = np.where(i < m, index[np.minimum(i, m - 1)], n)
+    return neighbors, np.sum(neighbors < n, axis=1)
+
+
+def _is_segment_inside_rings(p, R, radius, width, q0, q1):
+    # For each i, check if the segment from q0[i] to q1[i] passes through
+    # the ring with center p[i], orientation R[i], and size radius[i] and
+    # width[i] (i.e., if any point on the segment is inside the ring)
+
+    # Put both ends of each segment in the ring frame
+    a = np.einsum('nji,nj->ni', R, q0 - p)
+    b = np.einsum('nji,nj->ni', R, q1 - p)
+    d = b - a
+
+    # Find the part of each segment, from s0 to s1, that is close enough to
+    # the y-z plane of the ring frame (empty if s0 > s1)
+    h = width / 2
+    parallel = (d[:, 0] == 0.)
+    dx = np.where(parallel, 1., d[:, 0])
+    sa = (-h - a[:, 0]) / dx
+    sb = (h - a[:, 0]) / dx
+    s0 = np.where(parallel, 0., np.maximum(np.minimum(sa, sb), 0.))
+    s1 = np.where(parallel, np.where(np.abs(a[:, 0]) <= h, 1., -1.), np.minimum(np.maximum(sa, sb), 1.))
+
+    # Find the point in that part that is closest to the x axis of the ring
+    # frame, and check if it is close enough
+    dyz = d[:, 1]**2 + d[:, 2]**2
+    s = -(a[:, 1] * d[:, 1] + a[:, 2] * d[:, 2]) / np.where(dyz == 0., 1., dyz)
+    s = np.minimum(np.maximum(s, s0), s1)
+    y = a[:, 1] + s * d[:, 1]
+    z = a[:, 2] + s * d[:, 2]
+    return (s0 <= s1) & (y**2 + z**2 <= radius**2)
+
+
+def _get_controller_key(dirname, name, rules):
+    # Hash of the source of a controller (either a module {name}.py or all
+    # source files of a package {name}/), of its image, and of the rules it
+    # was checked with (a dict), which changes if any of these change
+    path = os.path.join(dirname, name)
+    if os.path.isdir(path):
+        filenames = sorted(
+            os.path.join(name, os.path.relpath(os.path.join(root, filename), path))
+            for root, _, files in os.walk(path) for filename in files if filename.endswith('.py')
+        )
+    else:
+        filenames = [f'{name}.py']
+    filenames.append(f'{name}.png')
+    h = hashlib.sha256()
+    for filename in filenames:
+        try:
+            with open(os.path.join(dirname, filename), 'rb') as f:
+                contents = f.read()
+        except FileNotFoundError:
+            contents = None
+        size = 'missing' if contents is None else len(contents)
+        h.update(f'{filename}:{size}:'.encode())
+        if contents is not None:
+            h.update(contents)
+    h.update(json.dumps(rules, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class _StdoutSink:
+    # Stands in for sys.stdout while controllers are being called, so that
+    # anything a controller prints can be caught without creating a new
+    # context manager and buffer for every call - text is captured between
+    # start(True) and stop(), and is passed through to stdout otherwise
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.capturing = False
+        self.text = []
+
+    def start(self, capture=True):
+        self.capturing = capture
+
+    def stop(self):
+        self.capturing = False
+        if not self.text:
+            return ''
+        text = ''.join(self.text)
+        self.text = []
+        return text
+
+    def write(self, s):
+        if self.capturing:
+            self.text.append(s)
+            return len(s)
+        return self.stdout.write(s)
+
+    def flush(self):
+        if not self.capturing:
+            self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+def _run_controller_process(dirname, name, conn, error_on_print):
+    # This runs in the worker process of a sandboxed controller. Requests
+    # come through conn, and each one gets exactly one reply of the form
+    # (status, result, stdout_val). Measurements and commands for run() are
+    # passed through shared memory, with this layout:
+    #
+    #  buf[0:4]: tau_x, tau_y, tau_z, f_z (written by the worker)
+    #  buf[4:12]: p_x, p_y, p_z, yaw, p_x_ring, p_y_ring, p_z_ring, is_last_ring
+    #  buf[12]: number of other drones (n)
+    #  buf[13:(13 + 3 * n)]: positions of other drones
+    #
+    module = None
+    controller = None
+    variables_to_log = []
+    shm = None
+    buf = None
+    sink = _StdoutSink(sys.stdout)
+    sys.stdout = sink
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        command = request[0]
+        if command == 'close':
+            break
+        try:
+            # (do not check for print while importing, as in load_drones)
+            sink.start(error_on_print and (command != 'load'))
+            try:
+                if command == 'attach':
+                    if shm is not None:
+                        buf = None
+                        shm.close()
+                    shm = shared_memory.SharedMemory(name=request[1])
+                    buf = np.ndarray((request[2],), dtype=np.float64, buffer=shm.buf)
+                    result = None
+                elif command == 'load':
+                    # (a different controller may be loaded by name, as in
+                    # validate_controllers)
+                    if len(request) > 1:
+                        name = request[1]
+                    module = importlib.import_module(f'.{name}', dirname)
+                    result = None
+                elif command == 'init':
+                    controller = module.Controller()
+                    variables_to_log = list(getattr(controller, 'variables_to_log', []))
+                    result = (list(controller.get_color()), variables_to_log)
+                elif command == 'reset':
+                    controller.reset(*request[1])
+                    result = None
+                elif command == 'run':
+                    n = int(buf[12])
+                    buf[0:4] = controller.run(
+                        buf[4],
+                        buf[5],
+                        buf[6],
+                        buf[7],
+                        buf[8],
+                        buf[9],
+                        buf[10],
+                        bool(buf[11]),
+                        buf[13:(13 + 3 * n)].reshape((n, 3)).copy(),
+                    )
+                    result = {}
+                    for key in variables_to_log:
+                        result[key] = getattr(controller, key, np.nan)
+                else:
+                    raise Exception(f'unknown request "{command}"')
+            finally:
+                stdout_val = sink.stop()
+            conn.send(('ok', result, stdout_val))
+        except Exception as err:
+            conn.send(('error', traceback.format_exc(), ''))
+    buf = None
+    if shm is not None:
+        shm.close()
+
+
+class _ControllerProcess:
+    # Runs a controller in its own process (see _run_controller_process) so
+    # that it cannot stall or crash the simulator, and so that controllers of
+    # different drones can run at the same time
+
+    def __init__(self, dirname, name, error_on_print):
+        self.dirname = dirname
+        self.name = name
+        self.error_on_print = error_on_print
+        self._start_process()
+        self.shm = None
+        self.buf = None
+        self.busy = False
+        self.start_time = None
+        self.color = None
+        self.variables_to_log = []
+        self.logged = {}
+
+    def _start_process(self):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_run_controller_process,
+            args=(self.dirname, self.name, child_conn, self.error_on_print),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def get_color(self):
+        return list(self.color)
+
+    def _receive(self):
+        try:
+            status, result, stdout_val = self.conn.recv()
+        except (EOFError, OSError):
+            self.process.join(timeout=1.)
+            raise Exception(f'Controller process died (exit code {self.process.exitcode})') from None
+        self.busy = False
+        if status == 'error':
+            raise Exception(f'Controller raised the following error:\n\n{result}')
+        if stdout_val:
+            raise Exception(f'Printed the following text to stdout, which is forbidden:\n\n{stdout_val}')
+        return result
+
+    def _call(self, request, timeout, label):
+        # Wait for an unfinished call to run, if there is one
+        if self.busy:
+            if not self.conn.poll(timeout):
+                raise Exception(f'{label} timeout exceeded: controller is still busy with a previous call to run')
+            self._receive()
+        start_time = time.perf_counter_ns()
+        self.conn.send(request)
+        if not self.conn.poll(timeout):
+            raise Exception(f'{label} timeout exceeded: {(time.perf_counter_ns() - start_time) * 1e-9} > {timeout}')
+        return self._receive()
+
+    def load(self, timeout, name=None):
+        if name is None:
+            self._call(('load', ), timeout, 'Load')
+        else:
+            self._call(('load', name), timeout, 'Load')
+
+    def init(self, timeout):
+        self.color, self.variables_to_log = self._call(('init', ), timeout, 'Init')
+
+    def reset(self, p_x_meas, p_y_meas, p_z_meas, yaw_meas, num_others, timeout):
+        # Make sure there is enough shared memory to pass the positions of
+        # all other drones
+        size = 13 + 3 * num_others
+        if (self.buf is None) or (self.buf.shape[0] < size):
+            self.close_shared_memory()
+            self.shm = shared_memory.SharedMemory(create=True, size=(8 * size))
+            self.buf = np.ndarray((size, ), dtype=np.float64, buffer=self.shm.buf)
+            self._call(('attach', self.shm.name, size), timeout, 'Reset')
+        self._call(('reset', (p_x_meas, p_y_meas, p_z_meas, yaw_meas)), timeout, 'Reset')
+
+    def start_run(self, p_x_meas, p_y_meas, p_z_meas, yaw_meas, p_x_ring, p_y_ring, p_z_ring, is_last_ring, pos_others):
+        # Returns False (and does nothing) if the controller is still busy
+        # with a call to run that missed its deadline on an earlier step
+        if self.busy:
+            if not self.conn.poll(0):
+                return False
+            self._receive()
+        n = pos_others.shape[0]
+        if 13 + 3 * n > self.buf.shape[0]:
+            raise Exception('Not enough shared memory for pos_others (reset the simulator after adding drones)')
+        self.buf[4:12] = (p_x_meas, p_y_meas, p_z_meas, yaw_meas, p_x_ring, p_y_ring, p_z_ring, is_last_ring)
+        self.buf[12] = n
+        self.buf[13:(13 + 3 * n)] = pos_others.flatten()
+        self.start_time = time.perf_counter_ns()
+        self.busy = True
+        self.conn.send(('run', ))
+        return True
+
+    def finish_run(self, deadline):
+        # Returns the commands from run (or None if they were not ready by
+        # the deadline, in which case the controller is left busy) - the
+        # deadline is in nanoseconds, as from time.perf_counter_ns(), or None
+        # to wait for as long as it takes
+        if not self.busy:
+            return None
+        if not self.conn.poll(None if deadline is None else max((deadline - time.perf_counter_ns()) * 1e-9, 0.)):
+            return None
+        self.logged = self._receive()
+        return self.buf[0:4].copy()
+
+    def close_shared_memory(self):
+        if self.shm is not None:
+            self.buf = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def kill(self):
+        # Stops the worker at once (it may be stuck in a call that will never
+        # return) and frees its shared memory - see restart
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.close_shared_memory()
+        self.busy = False
+
+    def restart(self, load_timeout, init_timeout):
+        # Starts a new worker (with a new instance of the controller) if the
+        # last one was killed or has died
+        if self.process.is_alive():
+            return
+        self.kill()
+        self._start_process()
+        self.load(load_timeout)
+        self.init(init_timeout)
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send(('close', ))
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=1.)
+            if self.process.is_alive():
+                self.process.kill()
+        self.conn.close()
+        self.close_shared_memory()
+
+
+class _VideoWriter:
+    # Writes frames to a video file - frames wait in a queue of bounded size
+    # and are encoded by a background thread, so the simulation only has to
+    # wait for the encoder when the queue is full. If fps is given, only
+    # every k-th time step is added to the video, with k chosen so that
+    # the video still plays in real time.
+
+    def __init__(self, filename, dt, fps=None, queue_size=32):
+        imageio = importlib.import_module('imageio')
+        if fps is None:
+            self.frame_interval = 1
+        else:
+            self.frame_interval = max(1, int(round(1 / (dt * fps))))
+        self.fps = 1 / (dt * self.frame_interval)
+        self.writer = imageio.get_writer(filename,
+                                         format='FFMPEG',
+                                         mode='I',
+                                         fps=self.fps)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.num_frames = 0
+        self.num_waits = 0
+        self.wait_time = 0.
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def _encode(self):
+        while True:
+            rgba = self.queue.get()
+            if rgba is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.writer.append_data(rgba)
+            except Exception as err:
+                self.error = err
+
+    def add(self, rgba):
+        if self.error is not None:
+            raise self.error
+        self.num_frames += 1
+        try:
+            self.queue.put_nowait(rgba)
+        except queue.Full:
+            start_time = time.time()
+            self.queue.put(rgba)
+            self.num_waits += 1
+            self.wait_time += time.time() - start_time
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+        return {
+            'num_frames': self.num_frames,
+            'num_waits': self.num_waits,
+            'wait_time': self.wait_time,
+        }
+
+
+class _Recorder:
+    # Writes the inputs to and outputs from the run method of each controller
+    # to a binary file. The file starts with a magic string, the length of a
+    # header, and the header itself (json). Then, for each time step, there
+    # is the time step and the number of records (uint32, uint16), the
+    # position of all drones (float64, one row per drone), and one record
+    # (see _record_dtype) per drone that ran at that time step. Positions of
+    # other drones are not stored in each record, since pos_others is just
+    # the position of all drones with one row deleted (or, if the header has
+    # num_neighbors or neighbor_radius, the rows given by _get_neighbors).
+
+    magic = b'AE353REC'
+    frame_struct = struct.Struct('<IH')
+
+    def __init__(self, filename, header):
+        self.num_drones = len(header['names'])
+        self.file = open(filename, 'wb')
+        header = json.dumps(header).encode('utf-8')
+        self.file.write(self.magic)
+        self.file.write(struct.pack('<I', len(header)))
+        self.file.write(header)
+        self.num_steps = 0
+
+    def add(self, time_step, all_pos, indices, pos_meas, yaw_meas, pos_ring, is_last_ring, u_cmd):
+        records = np.empty(len(indices), dtype=_record_dtype)
+        records['drone'] = indices
+        records['is_last_ring'] = is_last_ring
+        records['pos_meas'] = pos_meas
+        records['yaw_meas'] = yaw_meas
+        records['pos_ring'] = pos_ring
+        records['u_cmd'] = u_cmd
+        self.file.write(self.frame_struct.pack(time_step, len(indices)))
+        self.file.write(np.ascontiguousarray(all_pos, dtype=np.float64).tobytes())
+        self.file.write(records.tobytes())
+        self.num_steps += 1
+
+    def close(self):
+        self.file.close()
+        return {'num_steps': self.num_steps}
+
+
+_record_dtype = np.dtype([
+    ('drone', '<u2'),
+    ('is_last_ring', 'u1'),
+    ('pos_meas', '<f8', (3,)),
+    ('yaw_meas', '<f8'),
+    ('pos_ring', '<f8', (3,)),
+    ('u_cmd', '<f8', (4,)),
+])
+
+
+def read_recording(filename):
+    """
+    reads a file written by Simulator.start_recording and returns its
+    header (a dict) and a list of (time_step, all_pos, records) with one
+    item per time step, where records is a numpy structured array with
+    fields drone, is_last_ring, pos_meas, yaw_meas, pos_ring, u_cmd
+    """
+    with open(filename, 'rb') as f:
+        buffer = f.read()
+    if buffer[:len(_Recorder.magic)] != _Recorder.magic:
+        raise Exception(f'"{filename}" is not a recording')
+    offset = len(_Recorder.magic)
+    (header_length, ) = struct.unpack_from('<I', buffer, offset)
+    offset += 4
+    header = json.loads(buffer[offset:(offset + header_length)].decode('utf-8'))
+    offset += header_length
+    num_drones = len(header['names'])
+    frames = []
+    while offset < len(buffer):
+        time_step, num_records = _Recorder.frame_struct.unpack_from(buffer, offset)
+        offset += _Recorder.frame_struct.size
+        all_pos = np.frombuffer(buffer, dtype=np.float64, count=(3 * num_drones), offset=offset).reshape(num_drones, 3)
+        offset += all_pos.nbytes
+        records = np.frombuffer(buffer, dtype=_record_dtype, count=num_records, offset=offset)
+        offset += records.nbytes
+        frames.append((time_step, all_pos, records))
+    return header, frames
+
+
+def replay(filename, Controller, names=None, atol=0.):
+    """
+    feeds the inputs that were recorded for each drone (see start_recording)
+    to a new instance of Controller, with no physics, and compares what it
+    returns to the commands that were recorded - returns a dict with one item
+    per drone in names (all drones by default), each a dict with these items:
+
+     'num_steps': number of time steps that were replayed
+     'divergence': None if every command was within atol of the recorded one,
+                   otherwise a dict with the time_step, t, recorded command,
+                   and replayed command at the first time this was not so
+     'wall_time': time (in seconds) it took to replay
+
+    replay stops at the first divergence
+    """
+    header, frames = read_recording(filename)
+    if header['start_time_step'] != 0:
+        raise Exception(f'recording started at time step {header["start_time_step"]}, not at reset, so the state of each controller is unknown')
+    if names is None:
+        names = [name for name in header['names'] if header['reset'][name] is not None]
+    results = {}
+    for name in names:
+        if name not in header['names']:
+            raise Exception(f'the recording has no drone with name "{name}"')
+        if header['reset'][name] is None:
+            raise Exception(f'drone "{name}" was not reset before recording')
+        index = header['names'].index(name)
+        start_time = time.perf_counter()
+        controller = Controller()
+        controller.reset(*header['reset'][name])
+        num_steps = 0
+        divergence = None
+        for time_step, all_pos, records in frames:
+            i = np.flatnonzero(records['drone'] == index)
+            if len(i) == 0:
+                continue
+            record = records[i[0]]
+            if (header.get('num_neighbors') is None) and (header.get('neighbor_radius') is None):
+                pos_others = np.delete(all_pos, index, axis=0)
+            else:
+                active = np.zeros(len(all_pos), dtype=bool)
+                active[records['drone']] = True
+                neighbors, num_neighbors = _get_neighbors(all_pos, header['num_neighbors'], header['neighbor_radius'], active)
+                pos_others = all_pos[neighbors[index, :num_neighbors[index]]]
+            u_cmd = np.array(controller.run(
+                record['pos_meas'][0],
+                record['pos_meas'][1],
+                record['pos_meas'][2],
+                record['yaw_meas'],
+                record['pos_ring'][0],
+                record['pos_ring'][1],
+                record['pos_ring'][2],
+                bool(record['is_last_ring']),
+                pos_others,
+            ), dtype=float)
+            num_steps += 1
+            same = (np.abs(u_cmd - record['u_cmd']) <= atol) | (np.isnan(u_cmd) & np.isnan(record['u_cmd']))
+            if not np.all(same):
+                divergence = {
+                    'time_step': time_step,
+                    't': time_step * header['dt'],
+                    'recorded': record['u_cmd'].copy(),
+                    'replayed': u_cmd,
+                }
+                break
+        results[name] = {
+            'num_steps': num_steps,
+            'divergence': divergence,
+            'wall_time': time.perf_counter() - start_time,
+        }
+    return results
+
+
+class _Pacer:
+    # Keeps a simulation with a display at a real-time factor (simulated time
+    # divided by wall-clock time, or None to run as fast as possible), and
+    # says when to refresh the display - at most fps times per second of
+    # wall-clock time, however fast time is simulated. A refresh that is
+    # missed because time steps took too long is counted as dropped.
+
+    def __init__(self, dt, real_time_factor=1., fps=30., time_step=0):
+        self.dt = dt
+        self.real_time_factor = real_time_factor
+        self.frame_time = 1 / fps
+        self.start_time = time.perf_counter()
+        self.start_time_step = time_step
+        self.next_frame_time = self.start_time
+        self.num_frames = 0
+        self.num_dropped_frames = 0
+
+    def wait(self, time_step):
+        # Wait until the end of the given time step
+        if self.real_time_factor is None:
+            return
+        t = self.start_time + (self.dt * (time_step + 1 - self.start_time_step) / self.real_time_factor)
+        time_to_wait = t - time.perf_counter()
+        while time_to_wait > 0:
+            time.sleep(0.9 * time_to_wait)
+            time_to_wait = t - time.perf_counter()
+
+    def is_frame_due(self):
+        now = time.perf_counter()
+        if now < self.next_frame_time:
+            return False
+        num_missed = int((now - self.next_frame_time) / self.frame_time)
+        self.num_frames += 1
+        self.num_dropped_frames += num_missed
+        self.next_frame_time += (num_missed + 1) * self.frame_time
+        return True
+
+    def report(self, time_step):
+        elapsed_time = time.perf_counter() - self.start_time
+        return {
+            'real_time_factor': (((time_step - self.start_time_step) * self.dt) / elapsed_time) if elapsed_time > 0 else None,
+            'target_real_time_factor': self.real_time_factor,
+            'num_frames': self.num_frames,
+            'num_dropped_frames': self.num_dropped_frames,
+        }
+
+
+class _ContestCamera:
+    # Finds where the contest camera should point - the leader of a race is
+    # the drone that is farthest along x (but no farther than its next ring)
+    # while still near the course, and the camera target is the point on the
+    # path between rings that is even with the leader. The target follows
+    # this point with a first-order lag (time constant tau, in simulated
+    # seconds), so it moves smoothly when the leader changes.
+
+    def __init__(self, tau=0.25):
+        self.tau = tau
+        self.reset(np.array([[0., 0., 0.25]]))
+
+    def reset(self, ring_p):
+        self.ring_p = ring_p
+        self.t = None
+        self.target = None
+
+    def update(self, t, all_pos, cur_ring):
+        ring_p = self.ring_p
+
+        # position of leader along x
+        x = np.minimum(all_pos[:, 0], ring_p[np.minimum(cur_ring, len(ring_p) - 1), 0])
+        near = ((-7.5 < all_pos[:, 1]) & (all_pos[:, 1] < 7.5) & (0. < all_pos[:, 2]) & (all_pos[:, 2] < 5.))
+        x = np.max(x[near], initial=0.)
+
+        # point on path
+        target = np.array([
+            x,
+            np.interp(x, ring_p[:, 0], ring_p[:, 1]),
+            np.interp(x, ring_p[:, 0], ring_p[:, 2]),
+        ])
+
+        # move toward point
+        if (self.target is None) or (t <= self.t):
+            self.target = target
+        else:
+            self.target = self.target + (1. - np.exp(-(t - self.t) / self.tau)) * (target - self.target)
+        self.t = t
+        return self.target
 
 
 class Simulator:
 
+    # Variables that are logged (as float64) for each drone on each time step,
+    # in addition to "is_last_ring" (logged as bool) and "variables_to_log"
+    data_keys = [
+        't',
+        'p_x', 'p_y', 'p_z',
+        'yaw', 'pitch', 'roll',
+        'v_x', 'v_y', 'v_z',
+        'w_x', 'w_y', 'w_z',
+        'p_x_meas', 'p_y_meas', 'p_z_meas',
+        'yaw_meas',
+        'p_x_ring', 'p_y_ring', 'p_z_ring',
+        'tau_x', 'tau_y', 'tau_z', 'f_z',
+        'tau_x_cmd', 'tau_y_cmd', 'tau_z_cmd', 'f_z_cmd',
+        'run_time',
+    ]
+
+    # Edges of bins in the histogram of controller run times (20 bins per
+    # decade from 100 nanoseconds to 10 seconds)
+    run_time_bins_per_decade = 20
+    run_time_bin_edges = np.logspace(-7, 1, 8 * 20 + 1)
+
     def __init__(
                     self,
                     display=True,
@@ -22,6 +822,10 @@ class Simulator:
                     ring_separation=5.,
                     width=640,
                     height=480,
+                    renderer='auto',
+                    shadow=True,
+                    backend='pybullet',
+                    collisions='full',
                 ):
 
         # Random number generator
@@ -31,10 +835,29 @@ class Simulator:
         self.width = width
         self.height = height
 
-        # Time step
+        # Size of snapshots, unless given (the body view is always 128 x 128)
+        self.snapshot_width = 480
+        self.snapshot_height = 480
+
+        # Renderer and shadows for snapshots (see _get_renderer_flag)
+        self.renderer = renderer
+        self.renderer_flag = None
+        self.egl_plugin = None
+        self.shadow = shadow
+
+        # Time step (and time, which are both set again by reset)
         self.dt = 0.01
+        self.time_step = 0
+        self.t = 0.
+
+        # Real-time factor and rate of camera updates (see set_real_time_factor)
+        self.real_time_factor = 1.
+        self.display_fps = 30.
+        self.pacer = None
+        self.pacing_report = None
 
         # Whether or not to error on controller print or timeout
+        self.stdout_sink = None
         self.error_on_print = True
         self.error_on_timeout = True
         self.max_controller_run_time=1e-2
@@ -47,29 +870,116 @@ class Simulator:
         self.drones = []
         self.max_num_drones = 40
 
-        # Connect to and configure pybullet
+        # Shapes and textures that are shared by all drones (see _add_drone_body)
+        self.drone_shapes = None
+        self.textures = {}
+
+        # Key that identifies this simulator (see checkpoint and restore)
+        self.key = uuid.uuid4().hex
+
+        # Recorder of controller inputs and outputs (see start_recording)
+        self.recorder = None
+
+        # Verdicts from validate_controllers (keyed by _get_controller_key)
+        self.controller_verdicts = {}
+
+        # State of all drones (updated on each time step)
+        self.all_pos = None
+
+        # Physics backend - either 'pybullet', or 'numpy' for a rigid-body
+        # model of each drone that is integrated with numpy (no display, and
+        # no contact except with the ground - see _step_numpy).
+        #
+        # The numpy backend only pays off with many drones. Each call to
+        # numpy has a fixed cost, however few drones there are, so it is
+        # slower than pybullet with one drone, about as fast with ten, and
+        # faster with more. For a 45 s hover (see
+        # scripts/benchmark_backends.py, numbers depend on the computer):
+        #
+        #  drones   pybullet   numpy
+        #       1      1.6 s   2.4 s
+        #      10      4.8 s   4.9 s
+        #      40       30 s    13 s
+        #     150      253 s    40 s
+        #
+        # It also does not give the same results. Positions agree to within
+        # a micron in free fall. In pybullet, rotor forces act in a frame
+        # that lags by one substep, so a hovering drone drifts apart by a
+        # few millimeters. The ground model is much simpler, so a drone that
+        # hits the ground ends up centimeters away (see compare_backends).
+        # This is why the backend is never chosen automatically.
+        if backend not in ['pybullet', 'numpy']:
+            raise Exception(f'backend must be "pybullet" or "numpy" (not "{backend}")')
+        if (backend == 'numpy') and display:
+            raise Exception('the numpy backend has no display (use display=False)')
+        self.backend = backend
+
+        # Parameters of the rigid-body model used by the numpy backend (these
+        # are the same as in urdf/drone.urdf and in pybullet)
+        self.m = 0.5
+        self.J = np.array([0.0023, 0.0023, 0.004])
+        self.g = 9.81
+        self.damping = 0.04
+        self.num_substeps = 4
+        self.ground_height = 0.016 # <-- height of drone when resting on ground
+        self.restitution = 0.5
+        self.restitution_velocity_threshold = 0.05
+
+        # Terms of the numpy model that are quadratic in z = (v, w), the linear
+        # and angular velocity - these are products z[i] z[j] of the pairs
+        # (i, j) in self.quad_pairs, which self.quad_matrix maps (all at once)
+        # to the cross terms in the time derivative of v and w, and to the
+        # squared speeds |v|^2 and |w|^2 (see _get_accelerations_numpy)
+        J_x, J_y, J_z = self.J
+        quad_terms = [
+            # (i, j, column, coefficient)
+            (4, 2, 0, -1.), (5, 1, 0, 1.),        # -(w x v)
+            (5, 0, 1, -1.), (3, 2, 1, 1.),
+            (3, 1, 2, -1.), (4, 0, 2, 1.),
+            (4, 5, 3, -(J_z - J_y) / J_x),       # -(J_z - J_y) w_y w_z / J_x
+            (5, 3, 4, -(J_x - J_z) / J_y),       # -(J_x - J_z) w_z w_x / J_y
+            (3, 4, 5, -(J_y - J_x) / J_z),       # -(J_y - J_x) w_x w_y / J_z
+            (0, 0, 6, 1.), (1, 1, 6, 1.), (2, 2, 6, 1.), # |v|^2
+            (3, 3, 7, 1.), (4, 4, 7, 1.), (5, 5, 7, 1.), # |w|^2
+        ]
+        self.quad_pairs = np.array([term[0:2] for term in quad_terms]).T
+        self.quad_matrix = np.zeros((len(quad_terms), 8))
+        for row, (i, j, column, coefficient) in enumerate(quad_terms):
+            self.quad_matrix[row, column] = coefficient
+        self.quad_damping = np.array([0, 0, 0, 1, 1, 1])
+
+        # Connect to and configure pybullet (each simulator has its own physics
+        # client, so more than one simulator can exist in the same process)
         self.display = display
-        if self.display:
+        if self.backend == 'numpy':
+            self.physics_client = None
+        elif self.display:
             options = f'--width={width} --height={height}'
-            pybullet.connect(pybullet.GUI, options=options)
-            pybullet.configureDebugVisualizer(pybullet.COV_ENABLE_GUI, 0)
+            self.physics_client = pybullet.connect(pybullet.GUI, options=options)
+            pybullet.configureDebugVisualizer(pybullet.COV_ENABLE_GUI, 0, physicsClientId=self.physics_client)
         else:
-            pybullet.connect(pybullet.DIRECT)
-        pybullet.setGravity(0, 0, -9.81)
-        pybullet.setPhysicsEngineParameter(
-            fixedTimeStep=self.dt,
-            numSubSteps=4,
-            restitutionVelocityThreshold=0.05,
-            enableFileCaching=0,
-        )
+            self.physics_client = pybullet.connect(pybullet.DIRECT)
+        if self.physics_client is not None:
+            pybullet.setGravity(0, 0, -self.g, physicsClientId=self.physics_client)
+            pybullet.setPhysicsEngineParameter(
+                fixedTimeStep=self.dt,
+                numSubSteps=self.num_substeps,
+                restitutionVelocityThreshold=self.restitution_velocity_threshold,
+                enableFileCaching=0,
+                physicsClientId=self.physics_client,
+            )
 
         # Load plane
-        self.plane_id = pybullet.loadURDF(
-            os.path.join('.', 'urdf', 'plane.urdf'),
-            basePosition=np.array([0., 0., 0.]),
-            baseOrientation=pybullet.getQuaternionFromEuler([0., 0., 0.]),
-            useFixedBase=1,
-        )
+        if self.physics_client is None:
+            self.plane_id = None
+        else:
+            self.plane_id = pybullet.loadURDF(
+                os.path.join('.', 'urdf', 'plane.urdf'),
+                basePosition=np.array([0., 0., 0.]),
+                baseOrientation=pybullet.getQuaternionFromEuler([0., 0., 0.]),
+                useFixedBase=1,
+                physicsClientId=self.physics_client,
+            )
 
         # Load rings
         self.num_rings = num_rings
@@ -86,20 +996,37 @@ class Simulator:
             [0., np.pi / 2, 0.],
             2.5, 0.5, 'big-ring.urdf')
 
+        # Which other drones each controller is told about (see set_neighbors)
+        self.num_neighbors = None
+        self.neighbor_radius = None
+
+        # When a drone has crashed (see set_crash_detection) - this is off by
+        # default, so that drones fly as they always have unless asked
+        self.set_crash_detection(None, None, None)
+
+        # Which collisions are simulated - 'full' (drones collide with each
+        # other and with the world), 'world' (drones collide only with the
+        # plane and the rings), or 'none' (drones collide with nothing)
+        self.set_collisions(collisions)
+
         # Set contact parameters
         object_ids = [self.plane_id]
         for ring in self.rings:
             object_ids.append(ring['id'])
         for object_id in object_ids:
+            if object_id is None:
+                continue
             pybullet.changeDynamics(object_id, -1,
                 lateralFriction=1.0,
                 spinningFriction=0.0,
                 rollingFriction=0.0,
-                restitution=0.5,
+                restitution=self.restitution,
                 contactDamping=-1,
-                contactStiffness=-1)
+                contactStiffness=-1,
+                physicsClientId=self.physics_client)
 
         # Camera view
+        self.contest_camera = _ContestCamera()
         self.camera_drone_name = None
         self.camera_drone_yaw = None
         self.camera_viewfromstart = True
@@ -124,84 +1051,124 @@ class Simulator:
         self.max_spin_rate = 900 # <-- rad/s
         self.s_min = self.min_spin_rate**2
         self.s_max = self.max_spin_rate**2
-        self.M = linalg.inv(np.array([[0., 0., self.kF * self.l, -self.kF * self.l],
-                                      [-self.kF * self.l, self.kF * self.l, 0., 0.],
-                                      [-self.kM, -self.kM, self.kM, self.kM],
-                                      [self.kF, self.kF, self.kF, self.kF]]))
+        self.M_inv = np.array([[0., 0., self.kF * self.l, -self.kF * self.l],
+                               [-self.kF * self.l, self.kF * self.l, 0., 0.],
+                               [-self.kM, -self.kM, self.kM, self.kM],
+                               [self.kF, self.kF, self.kF, self.kF]])
+        self.M = linalg.inv(self.M_inv)
 
     def set_rules(self, error_on_print=True, error_on_timeout=True):
         self.error_on_print = error_on_print
         self.error_on_timeout = error_on_timeout
 
+    def _get_rules(self):
+        # Rules that decide whether a controller passes validation (see
+        # _get_controller_key)
+        return {
+            'error_on_print': self.error_on_print,
+            'error_on_timeout': self.error_on_timeout,
+            'max_controller_load_time': self.max_controller_load_time,
+            'max_controller_init_time': self.max_controller_init_time,
+            'max_controller_reset_time': self.max_controller_reset_time,
+            'max_controller_run_time': self.max_controller_run_time,
+        }
+
+    def set_neighbors(self, num_neighbors=None, radius=None):
+        """
+        limits pos_others (see run in each controller) to the num_neighbors
+        other drones that are nearest, or to the other drones that are within
+        radius (in meters), or both - these are sorted nearest first, and
+        their number can change from one time step to the next (the default,
+        with both None, is all other drones in order) - only drones that are
+        still running, with a finite position, are neighbors
+        """
+        if (num_neighbors is not None) and (num_neighbors < 0):
+            raise Exception(f'num_neighbors must be at least 0 (not {num_neighbors})')
+        if (radius is not None) and (radius <= 0):
+            raise Exception(f'radius must be positive (not {radius})')
+        self.num_neighbors = num_neighbors
+        self.neighbor_radius = radius
+
+    def set_crash_detection(self, max_tilt=np.pi / 2, min_altitude=0., takeoff_altitude=0.5):
+        """
+        a running drone has crashed - and is turned off and frozen in place - if
+        it tilts more than max_tilt (radians) from upright, if it goes below
+        min_altitude (meters), or if it touches the ground after it has been
+        above takeoff_altitude (meters) - any of these can be None to not
+        check it, so all three None turns off crash detection (the default)
+
+        a drone whose position or orientation is not finite (e.g., because
+        of commands that blew up the physics) has always crashed, whether
+        or not crash detection is on
+
+        call with no arguments to turn on crash detection with the default
+        thresholds
+        """
+        if (max_tilt is not None) and (max_tilt <= 0):
+            raise Exception(f'max_tilt must be positive (not {max_tilt})')
+        self.max_tilt = max_tilt
+        self.min_altitude = min_altitude
+        self.takeoff_altitude = takeoff_altitude
+
+    def set_collisions(self, collisions='full'):
+        if collisions not in ['full', 'world', 'none']:
+            raise Exception(f'collisions must be "full", "world", or "none" (not "{collisions}")')
+        self.collisions = collisions
+        if self.physics_client is None:
+            return
+        self._set_collision_filter(self.plane_id, is_drone=False)
+        for ring in self.rings:
+            self._set_collision_filter(ring['id'], is_drone=False)
+        for drone in self.drones:
+            if not drone.get('frozen', False):
+                self._set_collision_filter(drone['id'], is_drone=True)
+
+    def _set_collision_filter(self, id, is_drone):
+        # Drones are in group 2 and everything else (the plane and the rings)
+        # is in group 1 - pybullet lets two bodies collide if the group of
+        # either one is in the mask of the other, so pairs that are filtered
+        # out never even reach the narrowphase (only the base of each body
+        # has a shape)
+        if is_drone:
+            group = 2
+            mask = {'full': 1 | 2, 'world': 1, 'none': 0}[self.collisions]
+        else:
+            group = 1
+            mask = {'full': 2, 'world': 2, 'none': 0}[self.collisions]
+        pybullet.setCollisionFilterGroupMask(id, -1, group, mask, physicsClientId=self.physics_client)
+
     def clear_drones(self):
         for drone in self.drones:
-            pybullet.removeBody(drone['id'])
+            if drone['id'] is not None:
+                pybullet.removeBody(drone['id'], physicsClientId=self.physics_client)
+            if drone['sandbox']:
+                drone['controller'].close()
         self.drones = []
 
     def add_drone(self, Controller, name, image):
         if self.get_drone_by_name(name) is not None:
             raise Exception(f'drone with name "{name}" already exists')
         try:
-            # create instance of controller
-            controller_start_time = time.time()
-            if self.error_on_print:
-                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            # create instance of controller and get color (with the same rules
+            # for print as in a sandbox - see _run_controller_process)
+            controller_start_time = time.perf_counter_ns()
+            with self.capture_stdout():
+                self.stdout_sink.start(self.error_on_print)
+                try:
                     controller = Controller()
-                stdout_val = stdout.getvalue()
-                if stdout_val:
-                    raise Exception(f'Printed the following text to stdout, which is forbidden:\n\n{stdout_val}')
-            else:
-                controller = Controller()
-            controller_run_time = time.time() - controller_start_time
+                    color = controller.get_color()
+                finally:
+                    stdout_val = self.stdout_sink.stop()
+            if stdout_val:
+                raise Exception(f'Printed the following text to stdout, which is forbidden:\n\n{stdout_val}')
+            controller_run_time = (time.perf_counter_ns() - controller_start_time) * 1e-9
             if (controller_run_time > self.max_controller_init_time) and self.error_on_timeout:
                 raise Exception(f'Init timeout exceeded: {controller_run_time} > {self.max_controller_init_time}')
-
-            # get color
-            color = controller.get_color()
             assert(len(color) == 3)
             color.append(1.)
 
-            # get label
-            if image is not None:
-                texture_id = pybullet.loadTexture(image)
-
-            # load urdf
-            id = pybullet.loadURDF(os.path.join('.', 'urdf', 'drone.urdf'),
-                           basePosition=np.array([0., 0., 0.3]),
-                           baseOrientation=pybullet.getQuaternionFromEuler([0., 0., 0.]),
-                           useFixedBase=0,
-                           flags=(pybullet.URDF_USE_IMPLICIT_CYLINDER  |
-                                  pybullet.URDF_USE_INERTIA_FROM_FILE  ))
-            
-            # map joint names to joint indices and link names to link indices
-            joint_map = {}
-            link_map = {}
-            link_map['base'] = -1
-            for joint_id in range(pybullet.getNumJoints(id)):
-                joint_name = pybullet.getJointInfo(id, joint_id)[1].decode('UTF-8')
-                link_name = pybullet.getJointInfo(id, joint_id)[12].decode('UTF-8')
-                if link_name == 'base':
-                    raise Exception('cannot have a non-base link named "base"')
-                joint_map[joint_name] = joint_id
-                link_map[link_name] = joint_id
-
-            # apply color and label
-            pybullet.changeVisualShape(id, link_map['base'], rgbaColor=color)
-            if image is None:
-                pybullet.changeVisualShape(id, link_map['screen'], rgbaColor=[1., 1., 1., 0.])
-            else:
-                pybullet.changeVisualShape(id, link_map['screen'], rgbaColor=[1., 1., 1., 0.75], textureUniqueId=texture_id)
-
-            # set contact parameters
-            pybullet.changeDynamics(
-                id,
-                link_map['base'],
-                lateralFriction=1.0,
-                spinningFriction=0.0,
-                rollingFriction=0.0,
-                restitution=0.5,
-                contactDamping=-1,
-                contactStiffness=-1)
+            # create body
+            id, joint_map, link_map = self._add_drone_body(color, image)
             
             # get variables to log
             variables_to_log = getattr(controller, 'variables_to_log', [])
@@ -211,7 +1178,9 @@ class Simulator:
                 'module': None,
                 'Controller': Controller,
                 'name': name,
+                'image': image,
                 'controller': controller,
+                'sandbox': False,
                 'joint_map': joint_map,
                 'link_map': link_map,
                 'variables_to_log': variables_to_log,
@@ -221,85 +1190,254 @@ class Simulator:
             print(f'\n==========\n{traceback.format_exc()}==========\n')
     
     
-    def load_drones(self, dirname='students', no_max_num_drones=False):
+    def _add_drone_body(self, color, image):
+        # Returns the id of a new drone in pybullet, with maps from joint and
+        # link names to indices (there is no body with the numpy backend)
+        if self.physics_client is None:
+            return None, {}, {'base': -1}
+
+        # get label (each image is only loaded once)
+        if image is not None:
+            if image not in self.textures:
+                self.textures[image] = pybullet.loadTexture(image, physicsClientId=self.physics_client)
+            texture_id = self.textures[image]
+
+        # create shapes - these are the same as in urdf/drone.urdf, and are
+        # only created once (then shared by all drones)
+        if self.drone_shapes is None:
+            self.drone_shapes = {
+                'collision': pybullet.createCollisionShape(
+                    pybullet.GEOM_MESH,
+                    fileName=os.path.join('.', 'urdf', 'drone.stl'),
+                    physicsClientId=self.physics_client),
+                'visual': pybullet.createVisualShape(
+                    pybullet.GEOM_MESH,
+                    fileName=os.path.join('.', 'urdf', 'drone.stl'),
+                    physicsClientId=self.physics_client),
+                'screen': pybullet.createVisualShape(
+                    pybullet.GEOM_MESH,
+                    fileName=os.path.join('.', 'urdf', 'screen.obj'),
+                    meshScale=[0.25, 0.25, 0.25],
+                    visualFramePosition=[0., 0., 0.5],
+                    physicsClientId=self.physics_client),
+            }
+
+        # create body (with massless links "center_of_mass" and "screen",
+        # each attached to the base by a fixed joint)
+        id = pybullet.createMultiBody(
+            baseMass=self.m,
+            baseCollisionShapeIndex=self.drone_shapes['collision'],
+            baseVisualShapeIndex=self.drone_shapes['visual'],
+            basePosition=np.array([0., 0., 0.3]),
+            baseOrientation=pybullet.getQuaternionFromEuler([0., 0., 0.]),
+            linkMasses=[0., 0.],
+            linkCollisionShapeIndices=[-1, -1],
+            linkVisualShapeIndices=[-1, self.drone_shapes['screen']],
+            linkPositions=[[0., 0., 0.], [0., 0., 0.]],
+            linkOrientations=[[0., 0., 0., 1.], [0., 0., 0., 1.]],
+            linkInertialFramePositions=[[0., 0., 0.], [0., 0., 0.]],
+            linkInertialFrameOrientations=[[0., 0., 0., 1.], [0., 0., 0., 1.]],
+            linkParentIndices=[0, 0],
+            linkJointTypes=[pybullet.JOINT_FIXED, pybullet.JOINT_FIXED],
+            linkJointAxis=[[0., 0., 1.], [0., 0., 1.]],
+            physicsClientId=self.physics_client)
+        pybullet.changeDynamics(id, -1, localInertiaDiagonal=self.J, physicsClientId=self.physics_client)
+
+        # map joint names to joint indices and link names to link indices
+        joint_map = {'base_to_center_of_mass': 0, 'base_to_screen': 1}
+        link_map = {'base': -1, 'center_of_mass': 0, 'screen': 1}
+
+        # apply color and label
+        pybullet.changeVisualShape(id, link_map['base'], rgbaColor=color, physicsClientId=self.physics_client)
+        if image is None:
+            pybullet.changeVisualShape(id, link_map['screen'], rgbaColor=[1., 1., 1., 0.], physicsClientId=self.physics_client)
+        else:
+            pybullet.changeVisualShape(id, link_map['screen'], rgbaColor=[1., 1., 1., 0.75], textureUniqueId=texture_id, physicsClientId=self.physics_client)
+
+        # set contact parameters
+        pybullet.changeDynamics(
+            id,
+            link_map['base'],
+            lateralFriction=1.0,
+            spinningFriction=0.0,
+            rollingFriction=0.0,
+            restitution=self.restitution,
+            contactDamping=-1,
+            contactStiffness=-1,
+            physicsClientId=self.physics_client)
+
+        # set collision filter
+        self._set_collision_filter(id, is_drone=True)
+
+        return id, joint_map, link_map
+
+    def validate_controllers(self, dirname='students', names=None, workers=None, cache_filename=None):
+        """
+        imports and tests (init, reset, and one call to run) the controllers
+        in the directory "./dirname", many at the same time, each in its own
+        process - later calls to load_drones skip controllers that failed
+
+        verdicts are keyed by a hash of the source of each controller (a
+        module or a package), its image, and the rules (see set_rules) and
+        time limits, so a controller is only tested again if one of these
+        changes, and are saved to (and loaded from) the json file
+        cache_filename if it is given
+
+        returns a dict with the verdict {'passed': ..., 'error': ...} for
+        each controller, by name
+        """
+        if (cache_filename is not None) and os.path.exists(cache_filename):
+            with open(cache_filename, 'r') as f:
+                self.controller_verdicts.update(json.load(f))
+
+        # Find controllers that have not already been tested
+        keys = {}
+        for (_, name, _) in pkgutil.iter_modules([dirname]):
+            if (names is not None) and (name not in names):
+                continue
+            keys[name] = _get_controller_key(dirname, name, self._get_rules())
+        untested = [name for name, key in keys.items() if key not in self.controller_verdicts]
+
+        # Test them, with each of several threads testing its share of the
+        # controllers one after another in a worker process
+        if workers is None:
+            workers = os.cpu_count()
+        workers = max(1, min(workers, len(untested)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._validate_controllers, dirname, untested[i::workers])
+                for i in range(workers)
+            ]
+            for i, future in enumerate(futures):
+                for name, verdict in zip(untested[i::workers], future.result()):
+                    self.controller_verdicts[keys[name]] = verdict
+
+        if cache_filename is not None:
+            with open(cache_filename, 'w') as f:
+                json.dump(self.controller_verdicts, f)
+
+        return {name: self.controller_verdicts[key] for name, key in keys.items()}
+
+    def _validate_controllers(self, dirname, names):
+        # The same worker process is used to test one controller after
+        # another, until one fails (then it is replaced, in case the failure
+        # left it stuck or broken)
+        verdicts = []
+        controller = None
+        for name in names:
+            try:
+                if controller is None:
+                    controller = _ControllerProcess(dirname, name, self.error_on_print)
+                controller.load(self.max_controller_load_time if self.error_on_timeout else None, name)
+                controller.init(self.max_controller_init_time if self.error_on_timeout else None)
+                if len(controller.get_color()) != 3:
+                    raise Exception('get_color must return a list of length 3')
+                controller.reset(0., 0., 0.3, 0., 0, self.max_controller_reset_time if self.error_on_timeout else None)
+                controller.start_run(0., 0., 0.3, 0., 5., 0., 2., False, np.zeros((0, 3)))
+                # (the first call to run is allowed as much time as reset, as in _step)
+                u = controller.finish_run((controller.start_time + int(self.max_controller_reset_time * 1e9)) if self.error_on_timeout else None)
+                if u is None:
+                    raise Exception(f'Run timeout exceeded on first call to run: more than {self.max_controller_reset_time}')
+                if not np.all(np.isfinite(u)):
+                    raise Exception(f'Run returned actuator commands that are not finite: {u}')
+                image = os.path.join('.', dirname, f'{name}.png')
+                if not os.path.exists(image):
+                    raise Exception(f'Image {image} does not exist')
+                verdicts.append({'passed': True, 'error': None})
+            except Exception as err:
+                verdicts.append({'passed': False, 'error': traceback.format_exc()})
+                if controller is not None:
+                    controller.kill()
+                    controller = None
+        if controller is not None:
+            controller.close()
+        return verdicts
+
+    def load_drones(self, dirname='students', no_max_num_drones=False, names=None, sandbox=False):
+        """
+        if sandbox is True, each controller runs in its own process - this
+        makes max_controller_run_time a hard deadline on each call to run
+        after the first (the last command is used again if it is missed -
+        see _step) and allows the controllers of different drones to run at
+        the same time
+
+        controllers that are known to fail (see validate_controllers) are
+        skipped without being imported
+        """
         print(f'Try to import controllers from the directory "./{dirname}":')
         students = importlib.import_module(dirname)
         importlib.reload(students)
         failures = ''
         named_failures = []
         for (_, name, _) in pkgutil.iter_modules([dirname]):
+            # skip controllers that were not asked for (if a list of names was given)
+            if (names is not None) and (name not in names):
+                continue
+
             if (len(self.drones) >= self.max_num_drones) and (not no_max_num_drones):
                 raise Exception(f'The simulation already has the maximum number of drones ({self.max_num_drones})')
 
             print(f' ./{dirname}/{name}.py')
+            controller = None
             try:
                 # check if drone by this name already exists
                 if self.get_drone_by_name(name) is not None:
                     raise Exception(f'drone with name "{name}" already exists')
 
-                # load module
-                controller_start_time = time.time()
-                module = importlib.import_module(f'.{name}', dirname)
-                importlib.reload(module)
-                controller_run_time = time.time() - controller_start_time
-                if (controller_run_time > self.max_controller_load_time) and self.error_on_timeout:
-                    raise Exception(f'Load timeout exceeded: {controller_run_time} > {self.max_controller_load_time}')
-
-                # create instance of controller
-                controller_start_time = time.time()
-                if self.error_on_print:
-                    with contextlib.redirect_stdout(io.StringIO()) as stdout:
-                        controller = module.Controller()
-                    stdout_val = stdout.getvalue()
+                # check if controller is already known to fail (its source
+                # is only hashed if any controllers have been validated)
+                verdict = None
+                if len(self.controller_verdicts) > 0:
+                    key = _get_controller_key(dirname, name, self._get_rules())
+                    verdict = self.controller_verdicts.get(key, None)
+                if (verdict is not None) and (not verdict['passed']):
+                    raise Exception(f'Failed validation (see validate_controllers):\n\n{verdict["error"]}')
+
+                if sandbox:
+                    # load module and create instance of controller in a
+                    # separate process
+                    module = None
+                    controller = _ControllerProcess(dirname, name, self.error_on_print)
+                    try:
+                        controller.load(self.max_controller_load_time if self.error_on_timeout else None)
+                        controller.init(self.max_controller_init_time if self.error_on_timeout else None)
+                    except Exception as err:
+                        controller.kill()
+                        raise err
+                    color = controller.get_color()
+                else:
+                    # load module
+                    controller_start_time = time.perf_counter_ns()
+                    module = importlib.import_module(f'.{name}', dirname)
+                    importlib.reload(module)
+                    controller_run_time = (time.perf_counter_ns() - controller_start_time) * 1e-9
+                    if (controller_run_time > self.max_controller_load_time) and self.error_on_timeout:
+                        raise Exception(f'Load timeout exceeded: {controller_run_time} > {self.max_controller_load_time}')
+
+                    # create instance of controller and get color (with the
+                    # same rules for print as in a sandbox - see
+                    # _run_controller_process)
+                    controller_start_time = time.perf_counter_ns()
+                    with self.capture_stdout():
+                        self.stdout_sink.start(self.error_on_print)
+                        try:
+                            controller = module.Controller()
+                            color = controller.get_color()
+                        finally:
+                            stdout_val = self.stdout_sink.stop()
                     if stdout_val:
                         raise Exception(f'Printed the following text to stdout, which is forbidden:\n\n{stdout_val}')
-                else:
-                    controller = module.Controller()
-                controller_run_time = time.time() - controller_start_time
-                if (controller_run_time > self.max_controller_init_time) and self.error_on_timeout:
-                    raise Exception(f'Init timeout exceeded: {controller_run_time} > {self.max_controller_init_time}')
+                    controller_run_time = (time.perf_counter_ns() - controller_start_time) * 1e-9
+                    if (controller_run_time > self.max_controller_init_time) and self.error_on_timeout:
+                        raise Exception(f'Init timeout exceeded: {controller_run_time} > {self.max_controller_init_time}')
 
-                # get color
-                color = controller.get_color()
+                # check color
                 assert(len(color) == 3)
                 color.append(1.)
 
-                # get label
+                # create body (with label)
                 image = os.path.join('.', dirname, f'{name}.png')
-                texture_id = pybullet.loadTexture(image)
-
-                # load urdf
-                id = pybullet.loadURDF(os.path.join('.', 'urdf', 'drone.urdf'),
-                               basePosition=np.array([0., 0., 0.3]),
-                               baseOrientation=pybullet.getQuaternionFromEuler([0., 0., 0.]),
-                               useFixedBase=0,
-                               flags=(pybullet.URDF_USE_IMPLICIT_CYLINDER  |
-                                      pybullet.URDF_USE_INERTIA_FROM_FILE  ))
-
-                # map joint names to joint indices and link names to link indices
-                joint_map = {}
-                link_map = {}
-                link_map['base'] = -1
-                for joint_id in range(pybullet.getNumJoints(id)):
-                    joint_name = pybullet.getJointInfo(id, joint_id)[1].decode('UTF-8')
-                    link_name = pybullet.getJointInfo(id, joint_id)[12].decode('UTF-8')
-                    if link_name == 'base':
-                        raise Exception('cannot have a non-base link named "base"')
-                    joint_map[joint_name] = joint_id
-                    link_map[link_name] = joint_id
-
-                # apply color and label
-                pybullet.changeVisualShape(id, link_map['base'], rgbaColor=color)
-                pybullet.changeVisualShape(id, link_map['screen'], rgbaColor=[1., 1., 1., 0.75], textureUniqueId=texture_id)
-
-                # set contact parameters
-                pybullet.changeDynamics(id, -1,
-                    lateralFriction=1.0,
-                    spinningFriction=0.0,
-                    rollingFriction=0.0,
-                    restitution=0.5,
-                    contactDamping=-1,
-                    contactStiffness=-1)
+                id, joint_map, link_map = self._add_drone_body(color, image)
 
                 # get variables to log
                 variables_to_log = getattr(controller, 'variables_to_log', [])
@@ -307,14 +1445,18 @@ class Simulator:
                 self.drones.append({
                     'id': id,
                     'module': module,
-                    'Controller': module.Controller,
+                    'Controller': None if sandbox else module.Controller,
                     'name': name,
+                    'image': image,
                     'controller': controller,
+                    'sandbox': sandbox,
                     'joint_map': joint_map,
                     'link_map': link_map,
                     'variables_to_log': variables_to_log,
                 })
             except Exception as err:
+                if sandbox and (controller is not None):
+                    controller.close()
                 named_failures.append(name)
                 failures += f'\n==========\n{dirname}/{name}.py\n==========\n{traceback.format_exc()}==========\n'
         print(f'\n\nThe following controllers failed to import and were ignored:\n{failures}')
@@ -329,13 +1471,19 @@ class Simulator:
 
     def move_ring(self, pos, rpy, ring):
         ring['p'] = np.array(pos)
-        pybullet.resetBasePositionAndOrientation(ring['id'], pos, pybullet.getQuaternionFromEuler(rpy))
+        if ring['id'] is None:
+            return
+        pybullet.resetBasePositionAndOrientation(ring['id'], pos, pybullet.getQuaternionFromEuler(rpy), physicsClientId=self.physics_client)
 
     def add_ring(self, pos, rpy, radius, width, urdf):
-        id = pybullet.loadURDF(os.path.join('.', 'urdf', urdf),
-                        basePosition=pos,
-                        baseOrientation=pybullet.getQuaternionFromEuler(rpy),
-                        useFixedBase=1)
+        if self.physics_client is None:
+            id = None
+        else:
+            id = pybullet.loadURDF(os.path.join('.', 'urdf', urdf),
+                            basePosition=pos,
+                            baseOrientation=pybullet.getQuaternionFromEuler(rpy),
+                            useFixedBase=1,
+                            physicsClientId=self.physics_client)
         self.rings.append({
             'id': id,
             'p': np.array(pos),
@@ -362,33 +1510,22 @@ class Simulator:
         if not self.display:
             return
 
-        x = 0.
-        for drone in self.drones:
-            pos, ori = pybullet.getBasePositionAndOrientation(drone['id'])
-            if drone['cur_ring'] == len(self.rings):
-                xcur = min(pos[0], self.rings[-1]['p'][0])
-            else:
-                xcur = min(pos[0], self.rings[drone['cur_ring']]['p'][0])
-            if xcur > x:
-                if (-7.5 < pos[1] < 7.5) and (0. < pos[2] < 5.):
-                    x = xcur
-
-        y = 0.
-        z = 0.25
-        for ring_a, ring_b in zip(self.rings, self.rings[1:]):
-            if x <= ring_b['p'][0]:
-                m = (x - ring_a['p'][0]) / (ring_b['p'][0] - ring_a['p'][0])
-                y = (1 - m) * ring_a['p'][1] + m * ring_b['p'][1]
-                z = (1 - m) * ring_a['p'][2] + m * ring_b['p'][2]
-                break
-
-        pybullet.resetDebugVisualizerCamera(offset, yaw, pitch, [x, y, z])
+        # point camera at the leader (see _ContestCamera), using the position
+        # of each drone from the start of the last time step
+        if (self.all_pos is None) or (self.all_pos.shape[0] != len(self.drones)):
+            all_pos = np.empty((0, 3))
+            cur_ring = np.empty(0, dtype=int)
+        else:
+            all_pos = self.all_pos
+            cur_ring = np.array([drone['cur_ring'] for drone in self.drones], dtype=int)
+        target = self.contest_camera.update(self.t, all_pos, cur_ring)
+        pybullet.resetDebugVisualizerCamera(offset, yaw, pitch, target, physicsClientId=self.physics_client)
 
     def update_display(self):
         if self.display:
             # hack to get GUI to update on MacOS
             time.sleep(0.01)
-            keys = pybullet.getKeyboardEvents()
+            keys = pybullet.getKeyboardEvents(physicsClientId=self.physics_client)
 
     def camera(self):
         if self.display:
@@ -396,13 +1533,13 @@ class Simulator:
                 drone = self.get_drone_by_name(self.camera_drone_name)
                 if drone is None:
                     raise Exception(f'drone "{drone_name}" does not exist')
-                pos, ori = pybullet.getBasePositionAndOrientation(drone['id'])
+                pos, ori = pybullet.getBasePositionAndOrientation(drone['id'], physicsClientId=self.physics_client)
                 eul = pybullet.getEulerFromQuaternion(ori)
-                pybullet.resetDebugVisualizerCamera(3., (eul[2] * 180 / np.pi) + self.camera_drone_yaw, -15, pos)
+                pybullet.resetDebugVisualizerCamera(3., (eul[2] * 180 / np.pi) + self.camera_drone_yaw, -15, pos, physicsClientId=self.physics_client)
             elif self.camera_viewfromstart:
-                pybullet.resetDebugVisualizerCamera(5, -90, -30, [0., 0., 0.])
+                pybullet.resetDebugVisualizerCamera(5, -90, -30, [0., 0., 0.], physicsClientId=self.physics_client)
             else:
-                pybullet.resetDebugVisualizerCamera(5, 90, -30, self.rings[-1]['p'])
+                pybullet.resetDebugVisualizerCamera(5, 90, -30, self.rings[-1]['p'], physicsClientId=self.physics_client)
 
     def camera_startview(self):
         self.camera_viewfromstart = True
@@ -445,7 +1582,16 @@ class Simulator:
             self.update_display()
 
     def disconnect(self):
-        pybullet.disconnect()
+        for drone in self.drones:
+            if drone['sandbox']:
+                drone['controller'].close()
+        if self.physics_client is not None:
+            # unload the EGL plugin (if it was loaded for snapshots - see
+            # _get_renderer) before the physics client it belongs to is gone
+            if self.egl_plugin is not None:
+                pybullet.unloadPlugin(self.egl_plugin, physicsClientId=self.physics_client)
+                self.egl_plugin = None
+            pybullet.disconnect(physicsClientId=self.physics_client)
 
     def reset(self):
         # Reset time
@@ -453,213 +1599,780 @@ class Simulator:
         self.time_step = 0
         self.t = 0.
 
+        # Forget the state of all drones
+        self.all_pos = None
+
         # Do nothing else if there are no drones
         if len(self.drones) == 0:
             return
 
-        # Try to find a place for each drone in the start ring
+        # Find a place for each drone in (or, if there are too many drones,
+        # around) the start ring
         p = self._get_points(len(self.drones), 0.25, 2.5)
-        if p is None:
-            raise Exception('Placement failed! Try again.')
+
+        # State of all drones in the numpy backend (see _get_accelerations_numpy)
+        if self.backend == 'numpy':
+            self.x = np.zeros((len(self.drones), 12))
+            self.hit_ground = np.zeros(len(self.drones), dtype=bool)
 
         # Set the initial state of each drone
-        for drone, point in zip(self.drones, p.tolist()):
+        for index, (drone, point) in enumerate(zip(self.drones, p.tolist())):
+            # Start moving (see _freeze_drone)
+            self._unfreeze_drone(drone)
             # Position and orientation
             pos = np.array([point[0], point[1], 0.3])
             rpy = 0.01 * self.rng.standard_normal(3)
-            ori = pybullet.getQuaternionFromEuler(rpy)
-            pybullet.resetBasePositionAndOrientation(drone['id'], pos, ori)
             # Linear and angular velocity
             linvel = 0.01 * self.rng.standard_normal(3)
             angvel = 0.01 * self.rng.standard_normal(3)
-            pybullet.resetBaseVelocity(drone['id'],
-                                linearVelocity=linvel,
-                                angularVelocity=angvel)
-            # Actuator commands
+            if self.backend == 'numpy':
+                R = _get_matrices_from_eulers(rpy[np.newaxis, :])[0]
+                self.x[index, 0:3] = pos
+                self.x[index, 3:6] = rpy[2], rpy[1], rpy[0]
+                self.x[index, 6:9] = R.T @ linvel
+                self.x[index, 9:12] = R.T @ angvel
+            else:
+                ori = pybullet.getQuaternionFromEuler(rpy)
+                pybullet.resetBasePositionAndOrientation(drone['id'], pos, ori, physicsClientId=self.physics_client)
+                pybullet.resetBaseVelocity(drone['id'],
+                                    linearVelocity=linvel,
+                                    angularVelocity=angvel,
+                                    physicsClientId=self.physics_client)
+            # Buffer for the position of other drones (see set_neighbors)
+            drone['pos_others'] = np.empty((len(self.drones) - 1, 3))
+            # Actuator commands (and the last command from the controller)
             drone['u'] = np.zeros(4)
+            drone['u_cmd'] = np.zeros(4)
             # Index of target ring
             drone['cur_ring'] = 1
             # Data
-            drone['data'] = {
-                't': [],
-                'p_x': [],
-                'p_y': [],
-                'p_z': [],
-                'yaw': [],
-                'pitch': [],
-                'roll': [],
-                'v_x': [],
-                'v_y': [],
-                'v_z': [],
-                'w_x': [],
-                'w_y': [],
-                'w_z': [],
-                'p_x_meas': [],
-                'p_y_meas': [],
-                'p_z_meas': [],
-                'yaw_meas': [],
-                'p_x_ring': [],
-                'p_y_ring': [],
-                'p_z_ring': [],
-                'is_last_ring': [],
-                'tau_x': [],
-                'tau_y': [],
-                'tau_z': [],
-                'f_z': [],
-                'tau_x_cmd': [],
-                'tau_y_cmd': [],
-                'tau_z_cmd': [],
-                'f_z_cmd': [],
-                'run_time': [],
-            }
+            self._reset_data(drone)
             # Finish time
             drone['finish_time'] = None
+            # Crash (see check_crashes)
+            drone['took_off'] = False
+            drone['crashed'] = False
+            drone['crash_reason'] = None
+            drone['crash_time'] = None
             # Still running
             drone['running'] = True
             # Number of run time violations
             drone['num_run_time_violations'] = 0
+            # Histogram of controller run times
+            drone['run_time_counts'] = np.zeros(len(self.run_time_bin_edges) - 1, dtype=int)
+            drone['run_time_total'] = 0.
+            drone['run_time_max'] = 0.
             # Initialize controller
             try:
                 pos_meas = pos + self.pos_noise * self.rng.standard_normal(3)
                 yaw_meas = rpy[2] + self.yaw_noise * self.rng.standard_normal()
+                drone['reset_meas'] = [float(pos_meas[0]), float(pos_meas[1]), float(pos_meas[2]), float(yaw_meas)]
+
+                if drone['sandbox']:
+                    # (the worker was killed if the drone was turned off
+                    # after an error, as in _turn_off_drone)
+                    drone['controller'].restart(
+                        self.max_controller_load_time if self.error_on_timeout else None,
+                        self.max_controller_init_time if self.error_on_timeout else None,
+                    )
 
-                controller_start_time = time.time()
-                if self.error_on_print:
-                    with contextlib.redirect_stdout(io.StringIO()) as stdout:
-                        drone['controller'].reset(
-                            pos_meas[0],
-                            pos_meas[1],
-                            pos_meas[2],
-                            yaw_meas,
-                        )
-                    stdout_val = stdout.getvalue()
-                    if stdout_val:
-                        raise Exception(f'Printed the following text to stdout, which is forbidden:\n\n{stdout_val}')
-                else:
+                controller_start_time = time.perf_counter_ns()
+                if drone['sandbox']:
                     drone['controller'].reset(
                         pos_meas[0],
                         pos_meas[1],
                         pos_meas[2],
                         yaw_meas,
+                        len(self.drones) - 1,
+                        self.max_controller_reset_time if self.error_on_timeout else None,
                     )
-                controller_run_time = time.time() - controller_start_time
+                else:
+                    with self.capture_stdout():
+                        self.stdout_sink.start(self.error_on_print)
+                        try:
+                            drone['controller'].reset(
+                                pos_meas[0],
+                                pos_meas[1],
+                                pos_meas[2],
+                                yaw_meas,
+                            )
+                        finally:
+                            stdout_val = self.stdout_sink.stop()
+                    if stdout_val:
+                        raise Exception(f'Printed the following text to stdout, which is forbidden:\n\n{stdout_val}')
+                controller_run_time = (time.perf_counter_ns() - controller_start_time) * 1e-9
                 if (controller_run_time > self.max_controller_reset_time) and self.error_on_timeout:
                     raise Exception(f'Reset timeout exceeded: {controller_run_time} > {self.max_controller_reset_time}')
                 
-                # Try to add user-defined variables to data log
+                # Try to add user-defined variables to data log (storage for
+                # each one is created when the first value is logged, because
+                # that is when its size is known)
                 for key in drone['variables_to_log']:
                     if key in drone['data'].keys():
                         raise Exception(f'Trying to log duplicate variable {key} (choose a different name)')
-                    drone['data'][key] = []
+                    drone['data'][key] = None
             except Exception as err:
                 print(f'\n==========\nerror on reset of drone {drone["name"]} (turning it off):\n==========\n{traceback.format_exc()}==========\n')
-                drone['running'] = False
+                self._turn_off_drone(drone)
                 continue
 
         # Reset camera
+        self.contest_camera.reset(np.array([ring['p'] for ring in self.rings]))
         self.camera()
         self.update_display()
 
+    def _reset_data(self, drone, num_steps=1000):
+        # All float64 variables are stored in one array, with one row per
+        # variable and one column per time step, so that each variable is
+        # contiguous in memory and each time step can be logged at once
+        drone['data_buffer'] = np.empty((len(self.data_keys), num_steps))
+        drone['data_length'] = 0
+        drone['data'] = {}
+        for row, key in enumerate(self.data_keys):
+            drone['data'][key] = drone['data_buffer'][row]
+        drone['data']['is_last_ring'] = np.empty(num_steps, dtype=bool)
+
+    def _reserve_data(self, drone, num_steps):
+        # Make sure there is room to log at least num_steps more time steps
+        n = drone['data_length']
+        if (n + num_steps) <= drone['data_buffer'].shape[1]:
+            return
+        num_steps = max(n + num_steps, 2 * drone['data_buffer'].shape[1])
+        buffer = np.empty((len(self.data_keys), num_steps))
+        buffer[:, :n] = drone['data_buffer'][:, :n]
+        drone['data_buffer'] = buffer
+        for key, val in drone['data'].items():
+            if key in self.data_keys:
+                continue
+            if (val is None) or isinstance(val, list):
+                continue
+            new_val = np.full((num_steps,) + val.shape[1:], np.nan, dtype=val.dtype)
+            new_val[:n] = val[:n]
+            drone['data'][key] = new_val
+        for row, key in enumerate(self.data_keys):
+            drone['data'][key] = buffer[row]
+
+    def _log_variable(self, drone, key, val):
+        # A variable whose values are numbers (or fixed-size arrays of
+        # numbers) is stored in an array, which is created the first time it
+        # is logged - any other variable (e.g., one whose value is None or a
+        # string, or changes size) is stored in a list instead
+        data = drone['data']
+        n = drone['data_length']
+        if not isinstance(data[key], list):
+            try:
+                arr = np.asarray(val)
+                is_number = (arr.dtype.kind in 'biuf')
+            except Exception:
+                is_number = False
+            if is_number:
+                if not np.isscalar(val):
+                    arr = arr.flatten()
+                if data[key] is None:
+                    data[key] = np.full((drone['data_buffer'].shape[1],) + arr.shape, np.nan)
+                if arr.shape == data[key].shape[1:]:
+                    data[key][n] = arr
+                    return
+            # switch to a list (keeping the values logged so far)
+            data[key] = [np.nan] * n if data[key] is None else list(data[key][:n])
+        del data[key][n:]
+        data[key].append(val)
+
+    def _add_run_time(self, drone, run_time):
+        # Add run time (in seconds) to histogram of controller run times
+        if run_time > 0.:
+            i = int((math.log10(run_time) + 7) * self.run_time_bins_per_decade)
+            i = min(max(i, 0), len(drone['run_time_counts']) - 1)
+        else:
+            i = 0
+        drone['run_time_counts'][i] += 1
+        drone['run_time_total'] += run_time
+        if run_time > drone['run_time_max']:
+            drone['run_time_max'] = run_time
+
     def enforce_motor_limits(self, tau_x_des, tau_y_des, tau_z_des, f_z_des):
-        # pack inputs into array
-        u = np.array([tau_x_des, tau_y_des, tau_z_des, f_z_des])
-        # compute and bound squared spin rates
-        s = np.clip(self.M @ u, self.s_min, self.s_max)
-        # recompute inputs
-        u = linalg.solve(self.M, s)
+        u = self.enforce_motor_limits_all(np.array([[tau_x_des, tau_y_des, tau_z_des, f_z_des]]))[0]
         return u[0], u[1], u[2], u[3]
 
-    def set_actuator_commands(self, tau_x_des, tau_y_des, tau_z_des, f_z_des, drone):
-        tau_x, tau_y, tau_z, f_z = self.enforce_motor_limits(tau_x_des, tau_y_des, tau_z_des, f_z_des)
-        drone['u'] = np.array([tau_x, tau_y, tau_z, f_z])
-        return tau_x, tau_y, tau_z, f_z
+    def enforce_motor_limits_all(self, U):
+        # U is an n x 4 array, each row of which has the inputs
+        # [tau_x, tau_y, tau_z, f_z] for one drone
+        #
+        # compute and bound squared spin rates
+        S = np.clip(U @ self.M.T, self.s_min, self.s_max)
+        # recompute inputs
+        return S @ self.M_inv.T
+
+    def set_actuator_commands(self, U_des, drones):
+        # U_des is an n x 4 array, the ith row of which has the desired inputs
+        # [tau_x, tau_y, tau_z, f_z] for the ith drone in the list drones
+        U = self.enforce_motor_limits_all(U_des)
+        for drone, u in zip(drones, U):
+            drone['u'] = u
+        return U
+
+    def update_states(self):
+        # Get the state of all drones from pybullet, once per time step - all
+        # other methods that need the state of a drone read it from here
+        #
+        #  states[i, 0:3]: position (world frame)
+        #  states[i, 3:7]: orientation (quaternion [x, y, z, w])
+        #  states[i, 7:10]: linear velocity (world frame)
+        #  states[i, 10:13]: angular velocity (world frame)
+        #
+        if self.backend == 'numpy':
+            self._update_states_numpy()
+            return
+        states = np.empty((len(self.drones), 13))
+        for index, drone in enumerate(self.drones):
+            pos, ori = pybullet.getBasePositionAndOrientation(drone['id'], physicsClientId=self.physics_client)
+            linvel, angvel = pybullet.getBaseVelocity(drone['id'], physicsClientId=self.physics_client)
+            states[index] = pos + ori + linvel + angvel
+            drone['index'] = index
+        # position at the last time step (the same as now if there was no
+        # last time step), which is used to check for passing a ring
+        if (self.all_pos is None) or (self.all_pos.shape[0] != len(self.drones)):
+            self.prev_pos = states[:, 0:3].copy()
+        else:
+            self.prev_pos = self.all_pos
+        self.states = states
+        self.all_pos = states[:, 0:3]
+        self.all_R = _get_matrices_from_quaternions(states[:, 3:7])
+        self.all_rpy = _get_eulers_from_quaternions(states[:, 3:7])
+        # velocities in body frame (i.e., R^T v for each drone)
+        self.all_linvel = np.einsum('nji,nj->ni', self.all_R, states[:, 7:10])
+        self.all_angvel = np.einsum('nji,nj->ni', self.all_R, states[:, 10:13])
+
+    def _update_states_numpy(self):
+        # Does the same thing as update_states, but with the numpy backend
+        if self.x.shape[0] != len(self.drones):
+            raise Exception('must call reset() after adding or removing drones')
+        for index, drone in enumerate(self.drones):
+            drone['index'] = index
+        # angles are reported in [-pi, pi), like they are by pybullet
+        rpy = np.mod(self.x[:, [5, 4, 3]] + np.pi, 2 * np.pi) - np.pi
+        R = _get_matrices_from_eulers(rpy)
+        states = np.empty((len(self.drones), 13))
+        states[:, 0:3] = self.x[:, 0:3]
+        states[:, 3:7] = _get_quaternions_from_eulers(rpy)
+        # (both velocities are rotated to the world frame at once)
+        vw = np.matmul(R, np.reshape(self.x[:, 6:12], (-1, 2, 3)).transpose(0, 2, 1))
+        states[:, 7:13] = np.reshape(vw.transpose(0, 2, 1), (-1, 6))
+        if (self.all_pos is None) or (self.all_pos.shape[0] != len(self.drones)):
+            self.prev_pos = states[:, 0:3].copy()
+        else:
+            self.prev_pos = self.all_pos
+        self.states = states
+        self.all_pos = states[:, 0:3]
+        self.all_R = R
+        self.all_rpy = rpy
+        self.all_linvel = self.x[:, 6:9].copy()
+        self.all_angvel = self.x[:, 9:12].copy()
+
+    def _get_accelerations_numpy(self, x, c, s, f, tau, a):
+        # Equations of motion of all drones (see DeriveEOM-Template.ipynb),
+        # with the same damping as pybullet - each row of x is the state
+        #
+        #  x[i, 0:3]: position (world frame)
+        #  x[i, 3:6]: yaw, pitch, roll (ZYX Euler angles)
+        #  x[i, 6:9]: linear velocity (body frame)
+        #  x[i, 9:12]: angular velocity (body frame)
+        #
+        # c and s are the cosine and sine of x[:, 3:6], f is the thrust per
+        # unit mass, and tau is the torque per unit inertia of each drone -
+        # this puts the time derivative of x[:, 6:12] in a (all of these are
+        # computed once per step or substep, because with only a few drones
+        # the cost of each call to numpy matters more than the arithmetic)
+        z = x[:, 6:12]
+        # cross terms, and damping (per unit mass or inertia) that grows
+        # with speed
+        q = (z.take(self.quad_pairs[0], axis=1) * z.take(self.quad_pairs[1], axis=1)) @ self.quad_matrix
+        d = self.damping * (1. + np.sqrt(q[:, 6:8]))
+        np.subtract(q[:, 0:6], d.take(self.quad_damping, axis=1) * z, out=a)
+        # gravity (in the body frame), thrust, and torque
+        a[:, 0] += self.g * s[:, 1]
+        a[:, 1] -= self.g * c[:, 1] * s[:, 2]
+        a[:, 2] += f - self.g * c[:, 1] * c[:, 2]
+        a[:, 3:6] += tau
+
+    def _get_rates_numpy(self, x, c, s, r):
+        # Time derivative of x[:, 0:6] (see _get_accelerations_numpy), put in
+        # r - the velocity in the world frame is R v, with R = Rz Ry Rx
+        v_x, v_y, v_z = x[:, 6], x[:, 7], x[:, 8]
+        w_x, w_y, w_z = x[:, 9], x[:, 10], x[:, 11]
+        c_psi, c_theta, c_phi = c[:, 0], c[:, 1], c[:, 2]
+        s_psi, s_theta, s_phi = s[:, 0], s[:, 1], s[:, 2]
+        b = v_y * s_phi + v_z * c_phi
+        u_x = v_x * c_theta + b * s_theta
+        u_y = v_y * c_phi - v_z * s_phi
+        r[:, 0] = u_x * c_psi - u_y * s_psi
+        r[:, 1] = u_x * s_psi + u_y * c_psi
+        r[:, 2] = b * c_theta - v_x * s_theta
+        b = w_y * s_phi + w_z * c_phi
+        r[:, 3] = b / c_theta
+        r[:, 4] = w_y * c_phi - w_z * s_phi
+        r[:, 5] = w_x + b * s_theta / c_theta
+
+    def _step_numpy(self, U):
+        # Take one time step with the numpy backend, given the input to each
+        # drone - this is done like pybullet does it (the same number of
+        # substeps, each one updating velocity and then position), except
+        # that contact with the ground is modeled in the simplest possible
+        # way and contact with rings or other drones is not modeled at all
+        h = self.dt / self.num_substeps
+        x = self.x
+        frozen = [drone['index'] for drone in self.drones if drone['frozen']]
+        if len(frozen) > 0:
+            x_frozen = x[frozen]
+        f = U[:, 3] / self.m
+        tau = U[:, 0:3] / self.J
+        a = np.empty((x.shape[0], 6))
+        r = np.empty((x.shape[0], 6))
+        self.hit_ground[:] = False
+        for i in range(self.num_substeps):
+            # (the angles are the same for both parts of each substep)
+            c = np.cos(x[:, 3:6])
+            s = np.sin(x[:, 3:6])
+            self._get_accelerations_numpy(x, c, s, f, tau, a)
+            a *= h
+            x[:, 6:12] += a
+            self._get_rates_numpy(x, c, s, r)
+            r *= h
+            x[:, 0:6] += r
+
+            # drones that hit the ground bounce (if fast enough) and otherwise
+            # stop, with no sliding or rotation (unless collisions are off)
+            if self.collisions == 'none':
+                continue
+            hit = x[:, 2] < self.ground_height
+            if hit.any():
+                self.hit_ground |= hit
+                R = _get_matrices_from_eulers(x[hit][:, [5, 4, 3]])
+                v_z = np.einsum('nj,nj->n', R[:, 2, :], x[hit, 6:9])
+                v_z = np.where(v_z < -self.restitution_velocity_threshold, -self.restitution * v_z, np.maximum(v_z, 0.))
+                x[hit, 2] = self.ground_height
+                x[hit, 6:9] = R[:, 2, :] * v_z[:, np.newaxis]
+                x[hit, 9:12] = 0.
+        if len(frozen) > 0:
+            x[frozen] = x_frozen
 
     def get_sensor_measurements(self, drone):
-        pos, ori = pybullet.getBasePositionAndOrientation(drone['id'])
-        pos = np.array(pos)
-        rpy = np.array(pybullet.getEulerFromQuaternion(ori))
-        pos += self.pos_noise * self.rng.standard_normal(3)
-        yaw = rpy[2] + self.yaw_noise * self.rng.standard_normal()
+        index = drone['index']
+        pos = self.all_pos[index] + self.pos_noise * self.rng.standard_normal(3)
+        yaw = self.all_rpy[index, 2] + self.yaw_noise * self.rng.standard_normal()
         pos_ring = self.rings[drone['cur_ring']]['p'].copy()
         is_last_ring = ((drone['cur_ring'] + 1) == len(self.rings))
         return pos, yaw, pos_ring, is_last_ring
 
     def get_state(self, drone):
-        pos, ori = pybullet.getBasePositionAndOrientation(drone['id'])
-        rpy = pybullet.getEulerFromQuaternion(ori)
-        vel = pybullet.getBaseVelocity(drone['id'])
-        v_world = np.array(vel[0])
-        w_world = np.array(vel[1])
-        R_body_in_world = np.reshape(np.array(pybullet.getMatrixFromQuaternion(ori)), (3, 3))
-        v_body = R_body_in_world.T @ v_world
-        w_body = R_body_in_world.T @ w_world
-        return np.array(pos), np.array(rpy), v_body, w_body
-
-    def check_ring(self, drone):
-        pos, ori = pybullet.getBasePositionAndOrientation(drone['id'])
-        pos = np.array(pos)
-        if self.is_inside_ring(self.rings[drone['cur_ring']], pos):
+        index = drone['index']
+        return (
+            self.all_pos[index].copy(),
+            self.all_rpy[index].copy(),
+            self.all_linvel[index].copy(),
+            self.all_angvel[index].copy(),
+        )
+
+    def check_rings(self):
+        # Check (all at once) if each running drone passed through its next
+        # ring during the last time step - this is done by testing the path
+        # from its last position to its current position, and not only its
+        # current position, so that fast drones cannot skip through a ring
+        # between time steps
+        finished = np.zeros(len(self.drones), dtype=bool)
+        index = np.array([i for i, drone in enumerate(self.drones) if drone['running']], dtype=int)
+        if len(index) == 0:
+            return finished
+        cur_ring = np.array([self.drones[i]['cur_ring'] for i in index], dtype=int)
+        passed = _is_segment_inside_rings(
+            np.array([ring['p'] for ring in self.rings])[cur_ring],
+            np.array([ring['R'] for ring in self.rings])[cur_ring],
+            np.array([ring['radius'] for ring in self.rings])[cur_ring],
+            np.array([ring['width'] for ring in self.rings])[cur_ring],
+            self.prev_pos[index],
+            self.all_pos[index],
+        )
+
+        # Go to the next ring (and check if finished) for each drone that
+        # passed through its ring
+        for i in index[passed]:
+            drone = self.drones[i]
             drone['cur_ring'] += 1
-        if drone['cur_ring'] == len(self.rings):
-            drone['finish_time'] = self.t
-            return True
+            if drone['cur_ring'] == len(self.rings):
+                drone['finish_time'] = self.t
+                finished[i] = True
+        return finished
+
+    def check_crashes(self):
+        # Check (all at once) if each running drone that has not finished has
+        # crashed (see set_crash_detection), and if so remember why and when
+        crashed = np.zeros(len(self.drones), dtype=bool)
+        index = np.array([i for i, drone in enumerate(self.drones) if drone['running'] and (drone['finish_time'] is None)], dtype=int)
+        if len(index) == 0:
+            return crashed
+        pos = self.all_pos[index]
+
+        # Each reason for a crash, in order of priority - only those that are
+        # turned on are checked (a sum is not finite if any term is not, so
+        # one pass over each drone's sum finds any state that is not finite)
+        reasons = [(~np.isfinite(pos.sum(axis=1) + self.all_rpy[index].sum(axis=1)), 'nonfinite')]
+        if self.max_tilt is not None:
+            tilt = np.arccos(np.clip(self.all_R[index, 2, 2], -1., 1.))
+            reasons.append((tilt > self.max_tilt, 'tilt'))
+        if self.min_altitude is not None:
+            reasons.append((pos[:, 2] < self.min_altitude, 'altitude'))
+        if self.takeoff_altitude is not None:
+            for i in index[pos[:, 2] > self.takeoff_altitude]:
+                self.drones[i]['took_off'] = True
+            took_off = np.array([self.drones[i]['took_off'] for i in index], dtype=bool)
+            # Find drones that touched the ground during the last time step
+            # (from contact points with the plane, or in the numpy backend,
+            # from hits found by _step_numpy)
+            if (self.collisions == 'none') or not np.any(took_off):
+                on_ground = np.zeros(len(index), dtype=bool)
+            elif self.backend == 'numpy':
+                on_ground = self.hit_ground[index]
+            else:
+                ids = {contact[2] for contact in pybullet.getContactPoints(bodyA=self.plane_id, physicsClientId=self.physics_client)}
+                on_ground = np.array([self.drones[i]['id'] in ids for i in index], dtype=bool)
+            reasons.append((on_ground & took_off, 'ground'))
+
+        for is_crashed, reason in reasons:
+            for i in index[is_crashed & ~crashed[index]]:
+                drone = self.drones[i]
+                drone['crashed'] = True
+                drone['crash_reason'] = reason
+                drone['crash_time'] = self.t
+                crashed[i] = True
+        return crashed
+
+    def _turn_off_drone(self, drone):
+        # Turns off a drone after an error in its controller - a sandboxed
+        # controller may be stuck in a call that never returns, so its worker
+        # is killed (and a new one is started on reset)
+        drone['running'] = False
+        if drone['sandbox']:
+            drone['controller'].kill()
+
+    def _freeze_drone(self, drone):
+        # Stop moving a drone that is no longer running until the next reset
+        # - in pybullet, its body is made static (zero mass, which unlike
+        # putting it to sleep can be undone exactly) and collides with nothing,
+        # so it is not an obstacle to other drones and costs nothing to step
+        drone['frozen'] = True
+        if self.backend == 'numpy':
+            self.x[drone['index'], 6:12] = 0.
         else:
-            return False
+            pybullet.resetBaseVelocity(drone['id'], [0., 0., 0.], [0., 0., 0.], physicsClientId=self.physics_client)
+            pybullet.changeDynamics(drone['id'], -1, mass=0., physicsClientId=self.physics_client)
+            pybullet.setCollisionFilterGroupMask(drone['id'], -1, 0, 0, physicsClientId=self.physics_client)
+
+    def _unfreeze_drone(self, drone):
+        # Undo _freeze_drone
+        was_frozen = drone.get('frozen', False)
+        drone['frozen'] = False
+        if was_frozen and (self.backend == 'pybullet'):
+            pybullet.changeDynamics(drone['id'], -1, mass=self.m, localInertiaDiagonal=self.J, physicsClientId=self.physics_client)
+            self._set_collision_filter(drone['id'], is_drone=True)
+
+    def set_real_time_factor(self, real_time_factor=1., fps=30.):
+        """
+        with a display, runs the simulation at real_time_factor times real
+        time (from 0.25 to 20, or None for as fast as possible) and moves the
+        camera at most fps times per second - see pacing_report after run
+        """
+        if (real_time_factor is not None) and not (0.25 <= real_time_factor <= 20.):
+            raise Exception(f'real_time_factor must be between 0.25 and 20, or None (not {real_time_factor})')
+        if fps <= 0:
+            raise Exception(f'fps must be positive (not {fps})')
+        self.real_time_factor = real_time_factor
+        self.display_fps = fps
 
     def run(
             self,
             max_time=None,
             video_filename=None,
             contestview=False,
-            print_debug=False
+            print_debug=False,
+            video_fps=None,
+            video_width=None,
+            video_height=None,
+            record_filename=None,
         ):
 
         if max_time is None:
             self.max_time_steps = None
         else:
             self.max_time_steps = int((max_time + self.t) / self.dt)
-        self.start_time = time.time() - self.t
+        self.pacer = _Pacer(self.dt, self.real_time_factor, self.display_fps, self.time_step)
 
-        if video_filename is not None:
-            # Import imageio
-            imageio = importlib.import_module('imageio')
+        # Make room to log data for the whole run (if its length is known)
+        if self.max_time_steps is not None:
+            for drone in self.drones:
+                if 'data_buffer' in drone:
+                    self._reserve_data(drone, self.max_time_steps - self.time_step + 1)
 
-            # Open video
-            fps = int(1 / self.dt)
+        if video_filename is not None:
+            # Open video (see _VideoWriter)
+            video = _VideoWriter(video_filename, self.dt, fps=video_fps)
             if print_debug:
-                print(f'Creating a video with name {video_filename} and fps {fps}')
-            w = imageio.get_writer(video_filename,
-                                   format='FFMPEG',
-                                   mode='I',
-                                   fps=fps)
+                print(f'Creating a video with name {video_filename} and fps {video.fps:g}')
 
             # Add first frame to video
-            rgba = self.snapshot()
-            w.append_data(rgba)
+            video.add(self.snapshot(video_width, video_height))
 
-        while True:
-            all_done = self.step(contestview=contestview, print_debug=print_debug)
+        # Record controller inputs and outputs (see start_recording)
+        if record_filename is not None:
+            self.start_recording(record_filename)
 
-            if video_filename is not None:
-                if self.time_step % 100 == 0:
-                    if print_debug:
-                        print(f' {self.time_step} / {self.max_time_steps}')
+        # Catch anything printed by controllers (see capture_stdout)
+        with self.capture_stdout():
+            while True:
+                all_done = self.step(contestview=contestview, print_debug=print_debug)
 
-                # Add frame to video
-                rgba = self.snapshot()
-                w.append_data(rgba)
+                if video_filename is not None:
+                    if self.time_step % 100 == 0:
+                        if print_debug:
+                            print(f' {self.time_step} / {self.max_time_steps}')
 
-            if all_done:
-                break
+                    # Add frame to video (every k-th time step)
+                    if self.time_step % video.frame_interval == 0:
+                        video.add(self.snapshot(video_width, video_height))
 
-            if (self.max_time_steps is not None) and (self.time_step == self.max_time_steps):
-                break
+                if all_done:
+                    break
+
+                if (self.max_time_steps is not None) and (self.time_step == self.max_time_steps):
+                    break
 
         if video_filename is not None:
-            # Close video
-            w.close()
+            # Close video (after all frames have been encoded) and report if
+            # the simulation had to wait for the encoder
+            self.video_report = video.close()
+            if self.video_report['num_waits'] > 0:
+                print(f'The simulation waited {self.video_report["wait_time"]:.2f} seconds for the video encoder ({self.video_report["num_waits"]} of {self.video_report["num_frames"]} frames)')
+
+        if record_filename is not None:
+            self.stop_recording()
+
+        # Report the real-time factor and the number of dropped frames (see _Pacer)
+        self.pacing_report = self.pacer.report(self.time_step)
+        if self.display and print_debug:
+            print(f'Ran at {self.pacing_report["real_time_factor"]:.2f} times real time (target {self.real_time_factor}), moved the camera {self.pacing_report["num_frames"]} times ({self.pacing_report["num_dropped_frames"]} dropped)')
     
 
+    def checkpoint(self):
+        """
+        returns a token with the state of the simulation (physics, random
+        number generator, rings, each drone and its controller, and the
+        length of logged data) that can be given to restore - the token can
+        be pickled, and restoring it more than once gives the same result
+        each time (controllers must be picklable and cannot be sandboxed)
+
+        pybullet keeps a copy of its state for each token until release is
+        called with it, or until disconnect
+        """
+        if self.physics_client is None:
+            state_id = None
+            poses = None
+        else:
+            state_id = pybullet.saveState(physicsClientId=self.physics_client)
+            poses = []
+            for drone in self.drones:
+                pos, ori = pybullet.getBasePositionAndOrientation(drone['id'], physicsClientId=self.physics_client)
+                linvel, angvel = pybullet.getBaseVelocity(drone['id'], physicsClientId=self.physics_client)
+                poses.append((pos, ori, linvel, angvel))
+        drones = []
+        for drone in self.drones:
+            if drone['sandbox']:
+                raise Exception(f'cannot checkpoint drone "{drone["name"]}" because its controller is sandboxed')
+            drones.append({
+                'name': drone['name'],
+                'controller': pickle.dumps(drone['controller']),
+                'u': drone['u'].copy(),
+                'u_cmd': drone['u_cmd'].copy(),
+                'cur_ring': drone['cur_ring'],
+                'finish_time': drone['finish_time'],
+                'running': drone['running'],
+                'took_off': drone['took_off'],
+                'crashed': drone['crashed'],
+                'crash_reason': drone['crash_reason'],
+                'crash_time': drone['crash_time'],
+                'frozen': drone['frozen'],
+                'num_run_time_violations': drone['num_run_time_violations'],
+                'run_time_counts': drone['run_time_counts'].copy(),
+                'run_time_total': drone['run_time_total'],
+                'run_time_max': drone['run_time_max'],
+                'reset_meas': drone.get('reset_meas'),
+                'data_length': drone['data_length'],
+            })
+        return {
+            'simulator': self.key,
+            'state_id': state_id,
+            'poses': poses,
+            'x': self.x.copy() if self.backend == 'numpy' else None,
+            'hit_ground': self.hit_ground.copy() if self.backend == 'numpy' else None,
+            'rng': copy.deepcopy(self.rng.bit_generator.state),
+            'time_step': self.time_step,
+            't': self.t,
+            'all_pos': None if self.all_pos is None else self.all_pos.copy(),
+            'rings': [ring['p'].copy() for ring in self.rings],
+            'drones': drones,
+        }
+
+    def restore(self, token):
+        """
+        goes back to the state in a token from checkpoint - pybullet does not
+        save its contact cache, and it updates the frame of each link (where
+        rotor forces are applied) on restore rather than after each substep,
+        so drones may not follow exactly the same path as before (they differ
+        at first by rounding error, but a race can then play out differently)
+
+        the token can come from a different simulator with the same drones
+        (e.g., one in another process), in which case the position and
+        velocity of each drone are restored and data logged before the
+        checkpoint is not available
+        """
+        if [drone['name'] for drone in self.drones] != [drone['name'] for drone in token['drones']]:
+            raise Exception('cannot restore a checkpoint with different drones')
+        same_simulator = (token['simulator'] == self.key)
+
+        # Rings
+        for ring, p in zip(self.rings, token['rings']):
+            ring['p'] = p.copy()
+            if (ring['id'] is not None) and not same_simulator:
+                ori = pybullet.getBasePositionAndOrientation(ring['id'], physicsClientId=self.physics_client)[1]
+                pybullet.resetBasePositionAndOrientation(ring['id'], p, ori, physicsClientId=self.physics_client)
+
+        # Physics
+        if self.backend == 'numpy':
+            self.x = token['x'].copy()
+            self.hit_ground = token['hit_ground'].copy()
+        elif same_simulator and (token['state_id'] is not None):
+            pybullet.restoreState(token['state_id'], physicsClientId=self.physics_client)
+        else:
+            for drone, (pos, ori, linvel, angvel) in zip(self.drones, token['poses']):
+                pybullet.resetBasePositionAndOrientation(drone['id'], pos, ori, physicsClientId=self.physics_client)
+                pybullet.resetBaseVelocity(drone['id'],
+                                    linearVelocity=linvel,
+                                    angularVelocity=angvel,
+                                    physicsClientId=self.physics_client)
+
+        # Time and random number generator
+        self.rng.bit_generator.state = copy.deepcopy(token['rng'])
+        self.time_step = token['time_step']
+        self.t = token['t']
+        self.all_pos = None if token['all_pos'] is None else token['all_pos'].copy()
+
+        # Drones
+        for drone, saved in zip(self.drones, token['drones']):
+            if drone['sandbox']:
+                raise Exception(f'cannot restore drone "{drone["name"]}" because its controller is sandboxed')
+            drone['controller'] = pickle.loads(saved['controller'])
+            for key in ['cur_ring', 'finish_time', 'running', 'took_off', 'crashed', 'crash_reason', 'crash_time', 'num_run_time_violations', 'run_time_total', 'run_time_max', 'reset_meas']:
+                drone[key] = saved[key]
+            if saved['frozen']:
+                self._freeze_drone(drone)
+            else:
+                self._unfreeze_drone(drone)
+            for key in ['u', 'u_cmd', 'run_time_counts']:
+                drone[key] = saved[key].copy()
+            if ('data_buffer' not in drone) or not same_simulator:
+                self._reset_data(drone)
+                for key in drone['variables_to_log']:
+                    drone['data'][key] = None
+            elif drone['data_length'] >= saved['data_length']:
+                drone['data_length'] = saved['data_length']
+            else:
+                raise Exception(f'data logged for drone "{drone["name"]}" is shorter than at the checkpoint')
+
+    def release(self, token):
+        """
+        frees the copy of the pybullet state that is kept for a token from
+        checkpoint - the token can still be restored afterward, but only
+        from the position and velocity of each drone (as if it came from a
+        different simulator)
+        """
+        if (token['simulator'] == self.key) and (token['state_id'] is not None):
+            pybullet.removeState(token['state_id'], physicsClientId=self.physics_client)
+        token['state_id'] = None
+
+    def fork(self, token=None):
+        """
+        returns a new simulator (with no display) that starts from the state
+        in token (or from the current state, if token is None) and that has
+        a copy of all data logged before then - the new simulator and this
+        one can be run independently of each other
+        """
+        if token is None:
+            token = self.checkpoint()
+            # (only the position and velocity of each drone are used in the
+            # new simulator, so the copy of the pybullet state is not needed)
+            self.release(token)
+        simulator = Simulator(
+            display=False,
+            pos_noise=self.pos_noise,
+            yaw_noise=self.yaw_noise,
+            num_rings=self.num_rings,
+            ring_separation=self.ring_separation,
+            backend=self.backend,
+            collisions=self.collisions,
+        )
+        simulator.set_rules(self.error_on_print, self.error_on_timeout)
+        simulator.set_neighbors(self.num_neighbors, self.neighbor_radius)
+        simulator.set_crash_detection(self.max_tilt, self.min_altitude, self.takeoff_altitude)
+        for drone in self.drones:
+            if drone['sandbox']:
+                simulator.disconnect()
+                raise Exception(f'cannot fork drone "{drone["name"]}" because its controller is sandboxed')
+            simulator.add_drone(drone['Controller'], drone['name'], drone['image'])
+        if len(simulator.drones) != len(self.drones):
+            simulator.disconnect()
+            raise Exception('could not add all drones to the new simulator')
+        simulator.reset()
+        simulator.restore(token)
+
+        # Copy data logged before the checkpoint
+        for source, drone, saved in zip(self.drones, simulator.drones, token['drones']):
+            n = min(source['data_length'], saved['data_length'])
+            simulator._reserve_data(drone, n)
+            drone['data_buffer'][:, :n] = source['data_buffer'][:, :n]
+            for key, val in source['data'].items():
+                if (key in self.data_keys) or (val is None):
+                    continue
+                if isinstance(val, list):
+                    drone['data'][key] = val[:n]
+                    continue
+                drone['data'][key] = np.full((drone['data_buffer'].shape[1],) + val.shape[1:], np.nan, dtype=val.dtype)
+                drone['data'][key][:n] = val[:n]
+            drone['data_length'] = n
+        return simulator
+
+    def start_recording(self, filename):
+        """
+        records the inputs to and outputs from the run method of each
+        controller at every time step (until stop_recording) in a compact
+        binary file - see read_recording and replay
+        """
+        if self.recorder is not None:
+            self.stop_recording()
+        self.recorder = _Recorder(filename, {
+            'version': 1,
+            'dt': self.dt,
+            'start_time_step': self.time_step,
+            'num_neighbors': self.num_neighbors,
+            'neighbor_radius': self.neighbor_radius,
+            'names': [drone['name'] for drone in self.drones],
+            'reset': {drone['name']: drone.get('reset_meas') for drone in self.drones},
+        })
+
+    def stop_recording(self):
+        if self.recorder is None:
+            return None
+        report = self.recorder.close()
+        self.recorder = None
+        return report
+
     def get_data(self, drone_name):
         # Try to get drone by name, returning if none exists
         drone = self.get_drone_by_name(drone_name)
@@ -674,14 +2387,28 @@ class Simulator:
             print(msg)
             return None
         
-        # Convert lists to numpy arrays and return the result
-        data = drone['data'].copy()
-        for key in data.keys():
-            data[key] = np.array(data[key])
+        # Return views of the data that has been logged so far (these are
+        # not copies - later time steps do not change them, unless restore
+        # has gone back to a checkpoint before their end, in which case they
+        # are overwritten by the time steps that are taken after it - so
+        # copy them to keep them, or to change them)
+        n = drone['data_length']
+        data = {}
+        for key, val in drone['data'].items():
+            if val is None:
+                data[key] = np.array([])
+            elif isinstance(val, list):
+                # (a copy, with one element per time step, for variables that
+                # are not stored in an array - see _log_variable)
+                data[key] = np.empty(n, dtype=object)
+                for i in range(n):
+                    data[key][i] = val[i]
+            else:
+                data[key] = val[:n]
         return data
     
 
-    def get_result(self, drone_name):
+    def get_result(self, drone_name, crash=False):
         # Try to get drone by name, returning if none exists
         drone = self.get_drone_by_name(drone_name)
         if drone is None:
@@ -709,37 +2436,225 @@ class Simulator:
             failed = False
             finished = True
             finish_time = drone['finish_time']
+
+        # Also return why and when the drone crashed (None if it did not - see
+        # set_crash_detection, which is off by default, so that only drones
+        # with a position or orientation that is not finite crash), if asked
+        if crash:
+            return failed, finished, finish_time, drone['crash_reason'], drone['crash_time']
         return failed, finished, finish_time
 
+    def evaluate(self, Controller, seeds, max_time=45.0, workers=None):
+        """
+        runs one drone with the given controller once for each seed (the
+        ring layout, start position, and sensor noise all come from the seed)
+        and returns a dict with these items:
+
+         'seeds': array of seeds
+         'data': dict with one array of size (number of seeds) x (number of
+                 time steps) x ... for each item in get_data - runs that
+                 stop early are padded with nan (or False)
+         'length': number of time steps in each run
+         'failed', 'finished', 'finish_time': result of each run (see
+                 get_result), with nan as the finish time of unfinished runs
+         'summary': dict with the finish rate, failure rate, and statistics
+                    of the finish time over all finished runs
+
+        seeds are split among a pool of worker processes, each of which
+        creates one simulator (with the same settings as this one) and then
+        reuses it for every seed it is given - Controller must be a class
+        that can be pickled (e.g., one defined at the top level of a module)
+        unless workers is 1, in which case everything runs in this process
+        """
+        seeds = [int(seed) for seed in seeds]
+        if len(seeds) == 0:
+            raise Exception('there must be at least one seed')
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(seeds)))
+        kwargs = {
+            'pos_noise': self.pos_noise,
+            'yaw_noise': self.yaw_noise,
+            'num_rings': self.num_rings,
+            'ring_separation': self.ring_separation,
+            'backend': self.backend,
+            'collisions': self.collisions,
+        }
+        rules = (self.error_on_print, self.error_on_timeout)
+
+        # Run seeds (each worker gets every k-th seed)
+        if workers == 1:
+            runs = _evaluate_seeds(Controller, seeds, max_time, kwargs, rules)
+        else:
+            runs = [None] * len(seeds)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(_evaluate_seeds, Controller, seeds[i::workers], max_time, kwargs, rules)
+                    for i in range(workers)
+                ]
+                for i, future in enumerate(futures):
+                    runs[i::workers] = future.result()
+
+        # Stack data from all runs (padding each one to the longest)
+        length = np.array([len(data['t']) for data, result in runs])
+        stacked = {}
+        for key in runs[0][0].keys():
+            vals = [data[key] for data, result in runs]
+            if any(val.size == 0 for val in vals):
+                continue
+            if vals[0].dtype == bool:
+                stacked[key] = np.zeros((len(runs), max(length)) + vals[0].shape[1:], dtype=bool)
+            else:
+                stacked[key] = np.full((len(runs), max(length)) + vals[0].shape[1:], np.nan)
+            for i, val in enumerate(vals):
+                stacked[key][i, :len(val)] = val
+
+        # Summarize results
+        failed = np.array([result[0] for data, result in runs])
+        finished = np.array([result[1] for data, result in runs])
+        finish_time = np.array([np.nan if result[2] is None else result[2] for data, result in runs])
+        finish_times = finish_time[finished]
+        summary = {
+            'num_runs': len(runs),
+            'num_finished': int(np.sum(finished)),
+            'num_failed': int(np.sum(failed)),
+            'finish_rate': float(np.mean(finished)),
+            'failure_rate': float(np.mean(failed)),
+        }
+        if len(finish_times) > 0:
+            summary['finish_time'] = {
+                'mean': float(np.mean(finish_times)),
+                'std': float(np.std(finish_times)),
+                'min': float(np.min(finish_times)),
+                'median': float(np.median(finish_times)),
+                'max': float(np.max(finish_times)),
+            }
+        else:
+            summary['finish_time'] = None
+
+        return {
+            'seeds': np.array(seeds),
+            'data': stacked,
+            'length': length,
+            'failed': failed,
+            'finished': finished,
+            'finish_time': finish_time,
+            'summary': summary,
+        }
+
+    @contextlib.contextmanager
+    def capture_stdout(self):
+        # Install a sink for stdout (see _StdoutSink) until the end of the
+        # with block - run() does this once, so there is no cost for each
+        # call to a controller (does nothing if a sink is already installed)
+        if self.stdout_sink is not None:
+            yield self.stdout_sink
+            return
+        self.stdout_sink = _StdoutSink(sys.stdout)
+        sys.stdout = self.stdout_sink
+        try:
+            yield self.stdout_sink
+        finally:
+            sys.stdout = self.stdout_sink.stdout
+            self.stdout_sink = None
+
+    def get_timing_report(self, drone_name):
+        # Try to get drone by name, returning if none exists
+        drone = self.get_drone_by_name(drone_name)
+        if drone is None:
+            drone_names = '\n'.join([d['name'] for d in self.drones])
+            msg = f'The simulator has no drone with name "{drone_name}".'
+            if len(drone_names) == 0:
+                msg += f' The simulator has no drones at all, in fact.'
+            else:
+                msg += f' The simulator has these drones:'
+                msg += f'\n==========\n{drone_names}\n==========\n'
+            print(msg)
+            return None
+
+        # Get percentiles from the histogram of run times (each one is the
+        # upper edge of a bin, so it is accurate to within about 12%, except
+        # for the maximum, which is exact)
+        counts = drone['run_time_counts']
+        num_calls = int(np.sum(counts))
+        report = {
+            'num_calls': num_calls,
+            'num_violations': drone['num_run_time_violations'],
+            'budget': self.max_controller_run_time,
+        }
+        if num_calls == 0:
+            for key in ['mean', 'p50', 'p90', 'p99', 'max', 'utilization']:
+                report[key] = np.nan
+            return report
+        cumulative_counts = np.cumsum(counts)
+        for key, q in [('p50', 0.50), ('p90', 0.90), ('p99', 0.99)]:
+            i = np.searchsorted(cumulative_counts, q * num_calls)
+            report[key] = float(min(self.run_time_bin_edges[i + 1], drone['run_time_max']))
+        report['mean'] = drone['run_time_total'] / num_calls
+        report['max'] = drone['run_time_max']
+
+        # Fraction of the run time budget used by the 99th percentile
+        report['utilization'] = report['p99'] / self.max_controller_run_time
+        return report
 
     def step(self, contestview=False, print_debug=False):
         """
         does one step in the simulation
         """
+        with self.capture_stdout():
+            return self._step(contestview, print_debug)
+
+    def _step(self, contestview, print_debug):
 
         # current time
         self.t = self.time_step * self.dt
 
-        # get position of all drones
-        all_pos = []
-        for drone in self.drones:
-            pos, ori = pybullet.getBasePositionAndOrientation(drone['id'])
-            all_pos.append(pos)
-        all_pos = np.array(all_pos)
+        # get state of all drones
+        self.update_states()
+        all_pos = self.all_pos
+
+        # check which drones have passed through rings, and which have crashed
+        finished = self.check_rings()
+        crashed = self.check_crashes()
+
+        # find the neighbors of all drones at once (see set_neighbors)
+        if (self.num_neighbors is None) and (self.neighbor_radius is None):
+            neighbors = None
+        else:
+            running = np.array([drone['running'] for drone in self.drones], dtype=bool)
+            neighbors, num_neighbors = _get_neighbors(all_pos, self.num_neighbors, self.neighbor_radius, running & ~finished & ~crashed)
+
+        # the first call to run after reset is allowed as much time as reset
+        # (a controller - or a newly spawned worker process - may do things
+        # on its first call that make it slow, like importing a module)
+        if self.time_step == 0:
+            max_run_time = self.max_controller_reset_time
+        else:
+            max_run_time = self.max_controller_run_time
 
         all_done = True
+        active_drones = []
+        sandboxed_drones = []
+        U_cmd = []
         for index, drone in enumerate(self.drones):
             # ignore the drone if it is not still running
             if not drone['running']:
                 continue
 
             # check if the drone has just now finished, and if so ignore it
-            if self.check_ring(drone):
+            if finished[index]:
                 if print_debug:
                     print(f'FINISHED: drone "{drone["name"]}" at time {drone["finish_time"]:.2f}')
                 drone['running'] = False
                 continue
 
+            # check if the drone has just now crashed, and if so turn it off
+            if crashed[index]:
+                if print_debug:
+                    print(f'CRASHED: drone "{drone["name"]}" at time {drone["crash_time"]:.2f} ({drone["crash_reason"]})')
+                drone['running'] = False
+                continue
+
             # the drone is not finished, so the simulation should continue
             all_done = False
 
@@ -749,31 +2664,45 @@ class Simulator:
             # get measurements
             pos_meas, yaw_meas, pos_ring, is_last_ring = self.get_sensor_measurements(drone)
 
+            # get position of other drones (all of them, or only neighbors)
+            if neighbors is None:
+                pos_others = np.delete(all_pos, index, axis=0)
+            else:
+                pos_others = drone['pos_others'][:num_neighbors[index]]
+                np.take(all_pos, neighbors[index, :num_neighbors[index]], axis=0, out=pos_others)
+
+            # start a sandboxed controller (its actuator commands are
+            # collected below, after all other controllers have been run)
+            if drone['sandbox']:
+                try:
+                    started = drone['controller'].start_run(
+                        pos_meas[0],
+                        pos_meas[1],
+                        pos_meas[2],
+                        yaw_meas,
+                        pos_ring[0],
+                        pos_ring[1],
+                        pos_ring[2],
+                        is_last_ring,
+                        pos_others,
+                    )
+                except Exception as err:
+                    print(f'\n==========\nerror on run of drone {drone["name"]} (turning it off):\n==========\n{traceback.format_exc()}==========\n')
+                    self._turn_off_drone(drone)
+                    continue
+                sandboxed_drones.append((
+                    drone,
+                    pos, rpy, linvel, angvel,
+                    pos_meas, yaw_meas, pos_ring, is_last_ring,
+                    started,
+                ))
+                continue
+
             # get actuator commands
             try:
-                controller_start_time = time.time()
-                if self.error_on_print:
-                    with contextlib.redirect_stdout(io.StringIO()) as stdout:
-                        (
-                            tau_x_cmd,
-                            tau_y_cmd,
-                            tau_z_cmd,
-                            f_z_cmd,
-                        ) = drone['controller'].run(
-                            pos_meas[0],
-                            pos_meas[1],
-                            pos_meas[2],
-                            yaw_meas,
-                            pos_ring[0],
-                            pos_ring[1],
-                            pos_ring[2],
-                            is_last_ring,
-                            np.delete(all_pos, index, axis=0),
-                        )
-                    stdout_val = stdout.getvalue()
-                    if stdout_val:
-                        raise Exception(f'Printed the following text to stdout, which is forbidden:\n\n{stdout_val}')
-                else:
+                controller_start_time = time.perf_counter_ns()
+                self.stdout_sink.start(self.error_on_print)
+                try:
                     (
                         tau_x_cmd,
                         tau_y_cmd,
@@ -788,110 +2717,183 @@ class Simulator:
                         pos_ring[1],
                         pos_ring[2],
                         is_last_ring,
-                        np.delete(all_pos, index, axis=0),
+                        pos_others,
                     )
-                controller_run_time = time.time() - controller_start_time
-                if (controller_run_time > self.max_controller_run_time):
+                finally:
+                    stdout_val = self.stdout_sink.stop()
+                if stdout_val:
+                    raise Exception(f'Printed the following text to stdout, which is forbidden:\n\n{stdout_val}')
+                controller_run_time = (time.perf_counter_ns() - controller_start_time) * 1e-9
+                if (controller_run_time > max_run_time):
                     drone['num_run_time_violations'] += 1
                 if (drone['num_run_time_violations'] >= self.max_run_time_violations) and self.error_on_timeout:
                     raise Exception(f'Maximum run time of {self.max_controller_run_time} was exceeded on {self.max_run_time_violations} occasions')
 
-                (
-                    tau_x,
-                    tau_y,
-                    tau_z,
-                    f_z,
-                ) = self.set_actuator_commands(
-                    tau_x_cmd,
-                    tau_y_cmd,
-                    tau_z_cmd,
-                    f_z_cmd,
-                    drone,
-                )
+                u_cmd = np.array([tau_x_cmd, tau_y_cmd, tau_z_cmd, f_z_cmd], dtype=float)
+                if not np.all(np.isfinite(u_cmd)):
+                    raise Exception(f'Actuator commands must be finite (not {u_cmd})')
             except Exception as err:
                 print(f'\n==========\nerror on run of drone {drone["name"]} (turning it off):\n==========\n{traceback.format_exc()}==========\n')
-                drone['running'] = False
+                self._turn_off_drone(drone)
                 continue
 
-            # apply rotor forces
-            pybullet.applyExternalForce(
-                drone['id'],
-                drone['link_map']['center_of_mass'],
-                np.array([0., 0., drone['u'][3]]),
-                np.array([0., 0., 0.]),
-                pybullet.LINK_FRAME,
+            # remember everything that is needed to apply commands and log data
+            active_drones.append((
+                drone,
+                pos, rpy, linvel, angvel,
+                pos_meas, yaw_meas, pos_ring, is_last_ring,
+                controller_run_time,
+            ))
+            U_cmd.append(u_cmd)
+
+        # get actuator commands from sandboxed controllers, which have been
+        # running at the same time - the maximum run time is a hard deadline
+        # for these controllers, and the last command is used again if it is
+        # missed
+        for (
+                drone,
+                pos, rpy, linvel, angvel,
+                pos_meas, yaw_meas, pos_ring, is_last_ring,
+                started,
+            ) in sandboxed_drones:
+            try:
+                controller = drone['controller']
+                if started:
+                    u_cmd = controller.finish_run(controller.start_time + int(max_run_time * 1e9))
+                else:
+                    u_cmd = None
+                controller_run_time = (time.perf_counter_ns() - controller.start_time) * 1e-9
+                if u_cmd is None:
+                    u_cmd = drone['u_cmd']
+                    drone['num_run_time_violations'] += 1
+                elif (controller_run_time > max_run_time):
+                    drone['num_run_time_violations'] += 1
+                if (drone['num_run_time_violations'] >= self.max_run_time_violations) and self.error_on_timeout:
+                    raise Exception(f'Maximum run time of {self.max_controller_run_time} was exceeded on {self.max_run_time_violations} occasions')
+                if not np.all(np.isfinite(u_cmd)):
+                    raise Exception(f'Actuator commands must be finite (not {u_cmd})')
+            except Exception as err:
+                print(f'\n==========\nerror on run of drone {drone["name"]} (turning it off):\n==========\n{traceback.format_exc()}==========\n')
+                self._turn_off_drone(drone)
+                continue
+            drone['u_cmd'] = u_cmd
+
+            active_drones.append((
+                drone,
+                pos, rpy, linvel, angvel,
+                pos_meas, yaw_meas, pos_ring, is_last_ring,
+                controller_run_time,
+            ))
+            U_cmd.append(u_cmd)
+
+        # apply motor limits to the commands of all drones at once
+        U_cmd = np.reshape(U_cmd, (-1, 4))
+        U = self.set_actuator_commands(U_cmd, [active[0] for active in active_drones])
+
+        # record what went into and came out of each controller
+        if self.recorder is not None:
+            self.recorder.add(
+                self.time_step,
+                all_pos,
+                [active[0]['index'] for active in active_drones],
+                [active[5] for active in active_drones],
+                [active[6] for active in active_drones],
+                [active[7] for active in active_drones],
+                [active[8] for active in active_drones],
+                U_cmd,
             )
 
-            # apply rotor torques
-            pybullet.applyExternalTorque(
-                drone['id'],
-                drone['link_map']['center_of_mass'],
-                np.array([drone['u'][0], drone['u'][1], drone['u'][2]]),
-                pybullet.LINK_FRAME,
-            )
+        for active, u_cmd, u in zip(active_drones, U_cmd, U):
+            (
+                drone,
+                pos, rpy, linvel, angvel,
+                pos_meas, yaw_meas, pos_ring, is_last_ring,
+                controller_run_time,
+            ) = active
+
+            if self.backend == 'pybullet':
+                # apply rotor forces
+                pybullet.applyExternalForce(
+                    drone['id'],
+                    drone['link_map']['center_of_mass'],
+                    np.array([0., 0., drone['u'][3]]),
+                    np.array([0., 0., 0.]),
+                    pybullet.LINK_FRAME,
+                    physicsClientId=self.physics_client,
+                )
+
+                # apply rotor torques
+                pybullet.applyExternalTorque(
+                    drone['id'],
+                    drone['link_map']['center_of_mass'],
+                    np.array([drone['u'][0], drone['u'][1], drone['u'][2]]),
+                    pybullet.LINK_FRAME,
+                    physicsClientId=self.physics_client,
+                )
 
-            # log data
-            data = drone['data']
-            data['t'].append(self.t)
-            data['p_x'].append(pos[0])
-            data['p_y'].append(pos[1])
-            data['p_z'].append(pos[2])
-            data['yaw'].append(rpy[2])
-            data['pitch'].append(rpy[1])
-            data['roll'].append(rpy[0])
-            data['v_x'].append(linvel[0])
-            data['v_y'].append(linvel[1])
-            data['v_z'].append(linvel[2])
-            data['w_x'].append(angvel[0])
-            data['w_y'].append(angvel[1])
-            data['w_z'].append(angvel[2])
-            data['p_x_meas'].append(pos_meas[0])
-            data['p_y_meas'].append(pos_meas[1])
-            data['p_z_meas'].append(pos_meas[2])
-            data['yaw_meas'].append(yaw_meas)
-            data['p_x_ring'].append(pos_ring[0])
-            data['p_y_ring'].append(pos_ring[1])
-            data['p_z_ring'].append(pos_ring[2])
-            data['is_last_ring'].append(is_last_ring)
-            data['tau_x'].append(tau_x)
-            data['tau_y'].append(tau_y)
-            data['tau_z'].append(tau_z)
-            data['f_z'].append(f_z)
-            data['tau_x_cmd'].append(tau_x_cmd)
-            data['tau_y_cmd'].append(tau_y_cmd)
-            data['tau_z_cmd'].append(tau_z_cmd)
-            data['f_z_cmd'].append(f_z_cmd)
-            data['run_time'].append(controller_run_time)
+            # log data (in the same order as self.data_keys)
+            self._reserve_data(drone, 1)
+            n = drone['data_length']
+            drone['data_buffer'][:, n] = (
+                self.t,
+                pos[0], pos[1], pos[2],
+                rpy[2], rpy[1], rpy[0],
+                linvel[0], linvel[1], linvel[2],
+                angvel[0], angvel[1], angvel[2],
+                pos_meas[0], pos_meas[1], pos_meas[2],
+                yaw_meas,
+                pos_ring[0], pos_ring[1], pos_ring[2],
+                u[0], u[1], u[2], u[3],
+                u_cmd[0], u_cmd[1], u_cmd[2], u_cmd[3],
+                controller_run_time,
+            )
+            drone['data']['is_last_ring'][n] = is_last_ring
+            self._add_run_time(drone, controller_run_time)
             try:
                 for key in drone['variables_to_log']:
-                    val = getattr(drone['controller'], key, np.nan)
-                    if not np.isscalar(val):
-                        val = val.flatten().tolist()
-                    data[key].append(val)
+                    if drone['sandbox']:
+                        val = drone['controller'].logged.get(key, np.nan)
+                    else:
+                        val = getattr(drone['controller'], key, np.nan)
+                    self._log_variable(drone, key, val)
             except Exception as err:
                 print(f'\n==========\nerror logging data for drone {drone["name"]} (turning it off):\n==========\n{traceback.format_exc()}==========\n')
-                drone['running'] = False
+                self._turn_off_drone(drone)
+                drone['data_length'] += 1
                 continue
+            drone['data_length'] += 1
 
-        # try to stay real-time
+        # try to stay at the chosen real-time factor (see _Pacer)
         if self.display:
-            t = self.start_time + (self.dt * (self.time_step + 1))
-            time_to_wait = t - time.time()
-            while time_to_wait > 0:
-                time.sleep(0.9 * time_to_wait)
-                time_to_wait = t - time.time()
+            if self.pacer is None:
+                # step was called outside of run
+                self.pacer = _Pacer(self.dt, self.real_time_factor, self.display_fps, self.time_step)
+            self.pacer.wait(self.time_step)
+
+        # freeze drones that are no longer running (finished, crashed, or
+        # turned off because of an error), so they are not simulated
+        for drone in self.drones:
+            if (not drone['running']) and (not drone['frozen']):
+                self._freeze_drone(drone)
 
         # take a simulation step
-        pybullet.stepSimulation()
+        if self.backend == 'numpy':
+            U_all = np.zeros((len(self.drones), 4))
+            for active, u in zip(active_drones, U):
+                U_all[active[0]['index']] = u
+            self._step_numpy(U_all)
+        else:
+            pybullet.stepSimulation(physicsClientId=self.physics_client)
 
         # increment time step
         self.time_step += 1
 
-        # update camera
-        if contestview:
-            self.camera_update_contest()
-        else:
-            self.camera_update()
+        # update camera (at most display_fps times per second)
+        if self.display and self.pacer.is_frame_due():
+            if contestview:
+                self.camera_update_contest()
+            else:
+                self.camera_update()
 
         return all_done
 
@@ -910,6 +2912,8 @@ class Simulator:
                 finished.append((drone['name'], drone['finish_time']))
             elif drone['running']:
                 still_running.append(drone['name'])
+            elif drone['crashed']:
+                failed.append(f'{drone["name"]:20s} : crashed ({drone["crash_reason"]}) at {drone["crash_time"]:.2f}')
             else:
                 failed.append(drone['name'])
 
@@ -926,9 +2930,34 @@ class Simulator:
         for d in failed:
             print(f' {d:20s}')
 
-    def snapshot(self):
+        print('\nCONTROLLER RUN TIME (ms)')
+        print(f' {"":20s}   {"p50":>6s}   {"p90":>6s}   {"p99":>6s}   {"max":>6s}   {"p99 / budget":>12s}')
+        for drone in self.drones:
+            if 'run_time_counts' not in drone:
+                continue
+            r = self.get_timing_report(drone['name'])
+            if r['num_calls'] == 0:
+                continue
+            print(f' {drone["name"]:20s} : {1e3 * r["p50"]:6.2f}   {1e3 * r["p90"]:6.2f}   {1e3 * r["p99"]:6.2f}   {1e3 * r["max"]:6.2f}   {100 * r["utilization"]:11.0f}%')
+
+    def _get_renderer_flag(self):
+        # Choose the renderer the first time a snapshot is taken (so the EGL
+        # plugin is only loaded if it is needed) - see _get_renderer
+        if self.renderer_flag is None:
+            self.renderer, self.renderer_flag, self.egl_plugin = _get_renderer(self.renderer, self.display, self.physics_client)
+        return self.renderer_flag
+
+    def snapshot(self, width=None, height=None):
+        # size of image, unless given (see __init__)
+        if width is None:
+            width = self.snapshot_width
+        if height is None:
+            height = self.snapshot_height
+
         # Note: you *must* specify a projectionMatrix when calling getCameraImage,
         # or you will get whatever view is currently shown in the GUI.
+        if self.physics_client is None:
+            raise Exception('cannot take a snapshot with the numpy backend')
 
         # World view
         if self.camera_viewfromstart:
@@ -939,8 +2968,8 @@ class Simulator:
             p_target = np.array(self.rings[-1]['p'])
         v_up = np.array([0., 0., 1.])
         view_matrix = pybullet.computeViewMatrix(p_eye, p_target, v_up)
-        projection_matrix = pybullet.computeProjectionMatrixFOV(fov=120, aspect=1.0, nearVal=0.01, farVal=100.0)
-        im = pybullet.getCameraImage(480, 480, viewMatrix=view_matrix, projectionMatrix=projection_matrix, renderer=pybullet.ER_BULLET_HARDWARE_OPENGL, shadow=1)
+        projection_matrix = pybullet.computeProjectionMatrixFOV(fov=120, aspect=(width / height), nearVal=0.01, farVal=100.0)
+        im = pybullet.getCameraImage(width, height, viewMatrix=view_matrix, projectionMatrix=projection_matrix, renderer=self._get_renderer_flag(), shadow=int(self.shadow), physicsClientId=self.physics_client)
         rgba_world = im[2]
 
         # Body view (picture-in-picture)
@@ -948,7 +2977,7 @@ class Simulator:
             drone = self.get_drone_by_name(self.camera_drone_name)
             if drone is None:
                 raise Exception(f'drone "{drone_name}" does not exist')
-            pos, ori = pybullet.getBasePositionAndOrientation(drone['id'])
+            pos, ori = pybullet.getBasePositionAndOrientation(drone['id'], physicsClientId=self.physics_client)
             o_body_in_world = np.array(pos)
             R_body_in_world = np.reshape(np.array(pybullet.getMatrixFromQuaternion(ori)), (3, 3))
             p_eye = o_body_in_world + R_body_in_world @ np.array([-1.5, 0., 0.5])
@@ -956,62 +2985,61 @@ class Simulator:
             v_up = (R_body_in_world[:, 2]).flatten()
             view_matrix = pybullet.computeViewMatrix(p_eye, p_target, v_up)
             projection_matrix = pybullet.computeProjectionMatrixFOV(fov=60.0, aspect=1.0, nearVal=0.01, farVal=100.0)
-            im = pybullet.getCameraImage(128, 128, viewMatrix=view_matrix, projectionMatrix=projection_matrix, renderer=pybullet.ER_BULLET_HARDWARE_OPENGL, shadow=0)
+            im = pybullet.getCameraImage(128, 128, viewMatrix=view_matrix, projectionMatrix=projection_matrix, renderer=self._get_renderer_flag(), shadow=0, physicsClientId=self.physics_client)
             rgba_body = im[2]
             rgba_world[10:138, 10:138, :] = rgba_body
 
         return rgba_world
 
-    def _get_rep_grad(self, p, i, params):
-        gradfrep = np.zeros(2)
-        for j in range(p.shape[0]):
-            if j != i:
-                v = p[i] - p[j]
-                vnorm = np.linalg.norm(v)
-                d = vnorm
-                dgrad = v / vnorm
-                if (d <= params['brep']):
-                    gradfrep += params['krep'] * ((1 / params['brep']) - (1 / d)) * (1 / (d ** 2)) * dgrad
-        v = p[i]
-        vnorm = np.linalg.norm(v)
-        d = params['radius'] - vnorm
-        dgrad = - v / vnorm
-        if (d <= params['brep']):
-            gradfrep += params['krep'] * ((1 / params['brep']) - (1 / d)) * (1 / (d ** 2)) * dgrad
-        d = np.linalg.norm(gradfrep)
-        if (d >= params['max_step']):
-            gradfrep *= (params['max_step'] / d)
-        return gradfrep
-
     def _get_step(self, p, params):
-        dp = []
-        for i in range(p.shape[0]):
-            dp.append(- params['kdes'] * self._get_rep_grad(p, i, params))
-        return np.array(dp)
-
-    def _get_dmin_for_point(self, p, j, params):
-        dmin = params['radius'] - np.linalg.norm(p[j])
-        for i in range(p.shape[0]):
-            if i != j:
-                d = np.linalg.norm(p[i] - p[j])
-                if d < dmin:
-                    dmin = d
-        return dmin
+        # Gradient step for all points at once - each point is pushed away
+        # from other points and from the edge of the circle when closer than
+        # brep (the step of each point is at most max_step)
+        v = p[:, np.newaxis, :] - p[np.newaxis, :, :]
+        d = np.linalg.norm(v, axis=2)
+        np.fill_diagonal(d, np.inf)
+        d = np.maximum(d, 1e-6)
+        k = np.where(d <= params['brep'], params['krep'] * ((1 / params['brep']) - (1 / d)) / (d ** 3), 0.)
+        gradfrep = np.einsum('ij,ijk->ik', k, v)
+        vnorm = np.maximum(np.linalg.norm(p, axis=1), 1e-6)
+        d = params['radius'] - vnorm
+        k = np.where(d <= params['brep'], params['krep'] * ((1 / params['brep']) - (1 / d)) / (d ** 2), 0.)
+        gradfrep -= (k / vnorm)[:, np.newaxis] * p
+        d = np.linalg.norm(gradfrep, axis=1)
+        gradfrep *= np.minimum(1., params['max_step'] / np.maximum(d, 1e-12))[:, np.newaxis]
+        return - params['kdes'] * gradfrep
 
     def _get_dmin(self, p, params):
-        dmin = np.inf
-        for i in range(p.shape[0]):
-            d = self._get_dmin_for_point(p, i, params)
-            if d < dmin:
-                dmin = d
-        return dmin
-
-    def _get_points(self, num_points, inner_radius, outer_radius):
-        # sample points in circle
-        pr = self.rng.uniform(low=0., high=outer_radius, size=(num_points,))
-        ph = self.rng.uniform(low=0., high=2*np.pi, size=(num_points,))
-        p = (pr * np.array([np.cos(ph), np.sin(ph)])).T
-        # do 25 steps of gradient descent to spread out the points
+        # Smallest distance between two points or between a point and the
+        # edge of the circle
+        d = np.linalg.norm(p[:, np.newaxis, :] - p[np.newaxis, :, :], axis=2)
+        np.fill_diagonal(d, np.inf)
+        return min(np.min(d), np.min(params['radius'] - np.linalg.norm(p, axis=1)))
+
+    def _get_hex_points(self, num_points, inner_radius, outer_radius):
+        # Points on a hexagonal grid with spacing 2 * inner_radius, closest
+        # to the center first - these stay at least 2 * inner_radius away
+        # from the edge of the circle on either side, so they go outside the
+        # circle if there is not enough room inside it
+        spacing = 2 * inner_radius
+        radius = outer_radius + 2 * spacing + np.sqrt(num_points * (spacing ** 2) / np.pi)
+        n = int(np.ceil(radius / spacing)) + 1
+        i, j = np.meshgrid(np.arange(-n, n + 1), np.arange(-n, n + 1))
+        p = spacing * np.column_stack([
+            (i + 0.5 * (j % 2)).flatten(),
+            (np.sqrt(3) / 2) * j.flatten(),
+        ])
+        r = np.linalg.norm(p, axis=1)
+        keep = (r <= outer_radius - spacing) | (r >= outer_radius + spacing)
+        p = p[keep]
+        r = r[keep]
+        order = np.lexsort((np.arctan2(p[:, 1], p[:, 0]), np.round(r, 9)))
+        return p[order[:num_points]]
+
+    def _get_points(self, num_points, inner_radius, outer_radius, num_tries=10):
+        # Use hexagonal grid if there is not enough room for all points in
+        # the circle - otherwise, try (a few times) to spread out points
+        # from random samples, and use hexagonal grid if this fails
         params = {
             'krep': 1.,
             'brep': 4 * inner_radius,
@@ -1021,9 +3049,202 @@ class Simulator:
             'radius': outer_radius,
             'max_step': 0.1,
         }
-        for i in range(50):
-            p += self._get_step(p, params)
-        if self._get_dmin(p, params) > 2 * inner_radius:
-            return p
-        else:
-            return None
+        p_hex = self._get_hex_points(num_points, inner_radius, outer_radius)
+        if np.max(np.linalg.norm(p_hex, axis=1)) > outer_radius:
+            return p_hex
+        for i in range(num_tries):
+            # sample points in circle
+            pr = self.rng.uniform(low=0., high=outer_radius, size=(num_points,))
+            ph = self.rng.uniform(low=0., high=2*np.pi, size=(num_points,))
+            p = (pr * np.array([np.cos(ph), np.sin(ph)])).T
+            # do 50 steps of gradient descent to spread out the points
+            for j in range(50):
+                p += self._get_step(p, params)
+            if self._get_dmin(p, params) > 2 * inner_radius:
+                return p
+        return p_hex
+
+
+def _evaluate_seeds(Controller, seeds, max_time, kwargs, rules):
+    # Create one simulator with one drone, then reuse it for every seed
+    simulator = Simulator(display=False, seed=seeds[0], **kwargs)
+    simulator.set_rules(*rules)
+    simulator.add_drone(Controller, 'drone', None)
+    if len(simulator.drones) == 0:
+        simulator.disconnect()
+        raise Exception('could not add drone with the given controller')
+    drone = simulator.drones[0]
+
+    runs = []
+    for seed in seeds:
+        # Move rings and start with a new instance of the controller
+        simulator.rng = np.random.default_rng(seed)
+        simulator.move_rings()
+        drone['controller'] = Controller()
+
+        # Reset and run
+        simulator.reset()
+        simulator.run(max_time=max_time)
+        data = {key: val.copy() for key, val in simulator.get_data('drone').items()}
+        runs.append((data, simulator.get_result('drone')))
+    simulator.disconnect()
+    return runs
+
+
+def _get_winner(results):
+    winning_name = None
+    winning_time = np.inf
+    for name, (failed, finished, finish_time) in results.items():
+        if not finished:
+            continue
+        if finish_time < winning_time:
+            winning_name = name
+            winning_time = finish_time
+    return winning_name, winning_time
+
+
+def _run_heat(dirname, names, seed, max_time):
+    # Create simulator (no display, so many heats can run at once)
+    simulator = Simulator(display=False, seed=seed)
+
+    # Move rings
+    simulator.move_rings()
+
+    # Load drones
+    simulator.load_drones(dirname, names=names)
+
+    # Reset and run
+    simulator.reset()
+    simulator.run(max_time=max_time)
+
+    # Get result of each drone
+    results = {}
+    for drone in simulator.drones:
+        results[drone['name']] = simulator.get_result(drone['name'])
+    simulator.disconnect()
+    return results
+
+
+def run_tournament(designs_dir, seed, workers=None, max_time=45.0):
+    """
+    runs a competitive race (semifinals, then a final) with all designs in
+    the directory designs_dir - the semifinals are run at the same time on
+    a pool of worker processes, and the bracket depends only on the seed
+    """
+
+    # Random number generator (bracket and ring layouts come from this)
+    rng = np.random.default_rng(seed)
+
+    # Find qualified drones (testing all of them at the same time)
+    simulator = Simulator(display=False, seed=seed)
+    verdicts = simulator.validate_controllers(designs_dir, workers=workers)
+    simulator.disconnect()
+    qualified = [name for name, verdict in sorted(verdicts.items()) if verdict['passed']]
+    disqualified = [name for name, verdict in sorted(verdicts.items()) if not verdict['passed']]
+    for name in disqualified:
+        print(f'\n==========\n{designs_dir}/{name}.py\n==========\n{verdicts[name]["error"]}==========\n')
+    print(f'QUALIFIED: {len(qualified)}, DISQUALIFIED: {len(disqualified)}')
+    if len(qualified) == 0:
+        raise Exception(f'no drones in "{designs_dir}" qualified')
+
+    # Create semifinal races
+    num_drones_per_semifinal = int(np.ceil(np.sqrt(len(qualified))))
+    racers = sorted(qualified)
+    rng.shuffle(racers)
+    semifinals = []
+    while len(racers) > 0:
+        semifinals.append({
+            'racers': racers[-num_drones_per_semifinal:],
+            'seed': int(rng.integers(2**32)),
+        })
+        racers = racers[:-num_drones_per_semifinal]
+    final = {'seed': int(rng.integers(2**32))}
+    print(f'There will be at most {num_drones_per_semifinal} drones in each of {len(semifinals)} semifinals.')
+
+    # Run semifinal races
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_run_heat, designs_dir, race['racers'], race['seed'], max_time)
+            for race in semifinals
+        ]
+        for index, (race, future) in enumerate(zip(semifinals, futures)):
+            race['results'] = future.result()
+            race['winner'], race['winning_time'] = _get_winner(race['results'])
+            print(f'SEMIFINAL {index + 1} / {len(semifinals)}: winner was {race["winner"]}')
+
+    # Run final race
+    final['racers'] = [race['winner'] for race in semifinals if race['winner'] is not None]
+    if len(final['racers']) == 0:
+        final['results'] = {}
+    else:
+        final['results'] = _run_heat(designs_dir, final['racers'], final['seed'], max_time)
+    final['winner'], final['winning_time'] = _get_winner(final['results'])
+    print(f'FINAL: winner was {final["winner"]}')
+
+    return {
+        'seed': seed,
+        'qualified': qualified,
+        'disqualified': disqualified,
+        'semifinals': semifinals,
+        'final': final,
+        'winner': final['winner'],
+    }
+
+
+def compare_backends(Controller, seed=None, max_time=10., threshold=0.1, **kwargs):
+    """
+    runs the same controller (from the same initial conditions and with the
+    same sensor noise) with both the pybullet backend and the numpy backend
+    and reports how far apart the two trajectories are:
+
+     'max_error': dict of the maximum absolute difference in each of p_x,
+                  p_y, p_z, yaw, pitch, roll, v_x, v_y, v_z, w_x, w_y, w_z
+     'position_error': distance between the two positions at each time
+     'divergence_time': first time at which the position error is more than
+                        threshold, or None if it never is
+     'result': dict with the result (see get_result) from each backend
+     'wall_time': dict with the time (in seconds) each backend took to run
+
+    other keyword arguments are passed to each Simulator
+    """
+    data = {}
+    result = {}
+    wall_time = {}
+    for backend in ['pybullet', 'numpy']:
+        simulator = Simulator(display=False, seed=seed, backend=backend, **kwargs)
+        simulator.add_drone(Controller, 'drone', None)
+        if len(simulator.drones) == 0:
+            simulator.disconnect()
+            raise Exception('could not add drone with the given controller')
+        simulator.reset()
+        start_time = time.perf_counter()
+        simulator.run(max_time=max_time)
+        wall_time[backend] = time.perf_counter() - start_time
+        data[backend] = simulator.get_data('drone')
+        result[backend] = simulator.get_result('drone')
+        simulator.disconnect()
+
+    # Compare over the time for which both backends have data
+    a = data['pybullet']
+    b = data['numpy']
+    n = min(len(a['t']), len(b['t']))
+    max_error = {}
+    for key in ['p_x', 'p_y', 'p_z', 'yaw', 'pitch', 'roll', 'v_x', 'v_y', 'v_z', 'w_x', 'w_y', 'w_z']:
+        error = a[key][:n] - b[key][:n]
+        if key in ['yaw', 'pitch', 'roll']:
+            error = np.mod(error + np.pi, 2 * np.pi) - np.pi
+        max_error[key] = float(np.max(np.abs(error))) if n > 0 else 0.
+    position_error = np.linalg.norm(np.column_stack([
+        a['p_x'][:n] - b['p_x'][:n],
+        a['p_y'][:n] - b['p_y'][:n],
+        a['p_z'][:n] - b['p_z'][:n],
+    ]), axis=1)
+    i = np.flatnonzero(position_error > threshold)
+    return {
+        't': a['t'][:n].copy(),
+        'max_error': max_error,
+        'position_error': position_error,
+        'divergence_time': float(a['t'][i[0]]) if len(i) > 0 else None,
+        'result': result,
+        'wall_time': wall_time,
+    }
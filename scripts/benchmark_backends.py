@@ -0,0 +1,117 @@
+from argparse import ArgumentParser
+import concurrent.futures
+import multiprocessing
+import importlib
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import numpy as np
+from benchmark_collisions import Controller
+
+# Compares the pybullet and numpy backends of the drone simulator - how long
+# a run takes with each one, as the number of drones grows, and how far apart
+# the positions of one drone are with each one (see compare_backends in the
+# simulator) while it hovers, while it falls with its rotors off (drones
+# start 0.3 m above the ground, so they touch it after about 0.24 s), and
+# after it has hit the ground. For example:
+#
+#  python scripts/benchmark_backends.py projects/04_drone
+
+BACKENDS = ['pybullet', 'numpy']
+
+class HoverController(Controller):
+    # Hovers one meter above where it starts, rather than flying to the same
+    # point as every other drone
+    def reset(self, p_x_meas, p_y_meas, p_z_meas, yaw_meas):
+        super().reset(p_x_meas, p_y_meas, p_z_meas, yaw_meas)
+        self.p_goal = np.array([p_x_meas, p_y_meas, 1.])
+
+class FallController(HoverController):
+    # Turns off the rotors, so the drone falls from where it starts
+    def run(self, *args):
+        return 0., 0., 0., 0.
+
+# name, controller, and simulated time (in seconds) of each accuracy case
+ACCURACY_CASES = [
+    ('hover', HoverController, 45.),
+    ('fall (in the air)', FallController, 0.2),
+    ('fall (to the ground)', FallController, 2.),
+]
+
+def benchmark(directory, backend, num_drones, max_time):
+    # This runs in its own process, so that each case starts from scratch
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    module = importlib.import_module('ae353_drone')
+    simulator = module.Simulator(display=False, seed=0, backend=backend)
+    simulator.set_rules(error_on_print=False, error_on_timeout=False)
+    for i in range(num_drones):
+        simulator.add_drone(HoverController, f'drone_{i}', None)
+    simulator.reset()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator.run(max_time=max_time)
+    run_time = time.perf_counter() - start_time
+    return {
+        'run_time': run_time,
+        'step_time': run_time / simulator.time_step,
+    }
+
+def accuracy(directory, Controller, max_time):
+    # This also runs in its own process
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    module = importlib.import_module('ae353_drone')
+    with contextlib.redirect_stdout(io.StringIO()):
+        comparison = module.compare_backends(Controller, seed=0, max_time=max_time)
+    return {
+        'max_position_error': float(np.max(comparison['position_error'])),
+        'final_position_error': float(comparison['position_error'][-1]),
+        'max_error': comparison['max_error'],
+    }
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('directory', help='directory with the drone simulator (e.g., projects/04_drone)')
+    parser.add_argument('--drones', default='1,10,40,150', help='comma-separated list of numbers of drones')
+    parser.add_argument('--max-time', type=float, default=45., help='simulated time (in seconds) for each speed case')
+    parser.add_argument('--repeats', type=int, default=3, help='number of times to run each speed case (the fastest run is kept)')
+    parser.add_argument('--json', metavar='outfile.json', default=None, help='file to which results are saved')
+    args = parser.parse_args()
+
+    directory = os.path.abspath(args.directory)
+    context = multiprocessing.get_context('spawn')
+    def submit(fn, *fn_args):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            return executor.submit(fn, directory, *fn_args).result()
+
+    # Speed (the fastest of several runs, which is the least affected by
+    # whatever else the computer is doing)
+    speed = []
+    print(f'{"drones":>7s} {"pybullet (s)":>13s} {"numpy (s)":>10s} {"pybullet (ms/step)":>19s} {"numpy (ms/step)":>16s} {"numpy/pybullet":>15s}')
+    for num_drones in [int(n) for n in args.drones.split(',')]:
+        result = {'num_drones': num_drones, 'max_time': args.max_time}
+        for backend in BACKENDS:
+            runs = [submit(benchmark, backend, num_drones, args.max_time) for i in range(args.repeats)]
+            result[backend] = min(runs, key=lambda run: run['run_time'])
+        ratio = result['numpy']['run_time'] / result['pybullet']['run_time']
+        speed.append(result)
+        print(f'{num_drones:7d} {result["pybullet"]["run_time"]:13.2f} {result["numpy"]["run_time"]:10.2f} {1e3 * result["pybullet"]["step_time"]:19.3f} {1e3 * result["numpy"]["step_time"]:16.3f} {ratio:15.2f}')
+
+    # Accuracy
+    accuracy_results = []
+    print(f'\n{"case":22s} {"time (s)":>9s} {"max error (m)":>14s} {"final error (m)":>16s}')
+    for (name, Controller, max_time) in ACCURACY_CASES:
+        result = {'case': name, 'max_time': max_time, **submit(accuracy, Controller, max_time)}
+        accuracy_results.append(result)
+        print(f'{name:22s} {max_time:9.1f} {result["max_position_error"]:14.2e} {result["final_position_error"]:16.2e}')
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'speed': speed, 'accuracy': accuracy_results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+from argparse import ArgumentParser
+import concurrent.futures
+import multiprocessing
+import importlib
+import json
+import os
+import sys
+import time
+import numpy as np
+from scipy import linalg
+
+# Measures how long one step of the drone simulator takes, as the number of
+# drones grows, with each collision setting (see set_collisions in the
+# simulator). All drones fly to the same point above the start ring, so they
+# crowd together and (with collisions='full') run into each other. For example:
+#
+#  python scripts/benchmark_collisions.py projects/04_drone
+
+class Controller:
+    def __init__(self):
+        # linear model about hover
+        m = 0.5
+        g = 9.81
+        J = np.array([0.0023, 0.0023, 0.004])
+        A = np.zeros((12, 12))
+        A[0:3, 6:9] = np.eye(3)
+        A[3:6, 9:12] = np.eye(3)
+        A[6, 4] = g
+        A[7, 3] = -g
+        B = np.zeros((12, 4))
+        B[9:12, 0:3] = np.diag(1 / J)
+        B[8, 3] = 1 / m
+        C = np.zeros((4, 12))
+        C[0:3, 0:3] = np.eye(3)
+        C[3, 5] = 1.
+
+        # controller and observer gains
+        Q = np.diag([10., 10., 10., 1., 1., 1., 1., 1., 1., 1., 1., 1.])
+        R = np.diag([100., 100., 100., 1.])
+        P = linalg.solve_continuous_are(A, B, Q, R)
+        self.K = linalg.solve(R, B.T @ P)
+        P = linalg.solve_continuous_are(A.T, C.T, np.eye(12), np.eye(4))
+        self.L = P @ C.T
+
+        self.A = A
+        self.B = B
+        self.C = C
+        self.f_z_eq = m * g
+        self.dt = 0.01
+        self.p_goal = np.array([0., 0., 1.])
+
+    def get_color(self):
+        return [0., 1., 0.]
+
+    def reset(self, p_x_meas, p_y_meas, p_z_meas, yaw_meas):
+        self.xhat = np.zeros(12)
+        self.xhat[0:3] = [p_x_meas, p_y_meas, p_z_meas]
+        self.xhat[5] = yaw_meas
+
+    def run(self, p_x_meas, p_y_meas, p_z_meas, yaw_meas, p_x_ring, p_y_ring, p_z_ring, is_last_ring, pos_others):
+        y = np.array([p_x_meas, p_y_meas, p_z_meas, yaw_meas])
+        xdes = np.zeros(12)
+        xdes[0:3] = self.p_goal
+        u = -self.K @ (self.xhat - xdes)
+        self.xhat += self.dt * (self.A @ self.xhat + self.B @ u - self.L @ (self.C @ self.xhat - y))
+        return u[0], u[1], u[2], u[3] + self.f_z_eq
+
+def benchmark(directory, collisions, num_drones, num_steps, backend):
+    # This runs in its own process, so that each case starts from scratch
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    module = importlib.import_module('ae353_drone')
+    simulator = module.Simulator(display=False, seed=0, backend=backend, collisions=collisions)
+    simulator.set_rules(error_on_print=False, error_on_timeout=False)
+    # drones that crash into each other are kept running, so that they are
+    # still simulated (see set_crash_detection in the simulator)
+    simulator.set_crash_detection(None, None, None)
+    for i in range(num_drones):
+        simulator.add_drone(Controller, f'drone_{i}', None)
+    simulator.reset()
+
+    step_times = []
+    for i in range(num_steps):
+        start_time = time.perf_counter()
+        simulator.step()
+        step_times.append(time.perf_counter() - start_time)
+    step_times = np.array(step_times)
+
+    num_contacts = 0
+    if simulator.physics_client is not None:
+        import pybullet
+        num_contacts = len(pybullet.getContactPoints(physicsClientId=simulator.physics_client))
+    return {
+        'mean': float(np.mean(step_times)),
+        'p50': float(np.percentile(step_times, 50)),
+        'p95': float(np.percentile(step_times, 95)),
+        'num_contacts': num_contacts,
+    }
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('directory', help='directory with the drone simulator (e.g., projects/04_drone)')
+    parser.add_argument('--collisions', default='full,world,none', help='comma-separated list of collision settings')
+    parser.add_argument('--drones', default='1,10,40,150', help='comma-separated list of numbers of drones')
+    parser.add_argument('--steps', type=int, default=300, help='number of steps to time for each case')
+    parser.add_argument('--backend', default='pybullet', help='physics backend (pybullet or numpy)')
+    parser.add_argument('--json', metavar='outfile.json', default=None, help='file to which results are saved')
+    args = parser.parse_args()
+
+    directory = os.path.abspath(args.directory)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    print(f'{"collisions":10s} {"drones":>7s} {"mean (ms)":>10s} {"p50 (ms)":>9s} {"p95 (ms)":>9s} {"contacts":>9s}')
+    for num_drones in [int(n) for n in args.drones.split(',')]:
+        for collisions in args.collisions.split(','):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                future = executor.submit(benchmark, directory, collisions, num_drones, args.steps, args.backend)
+                try:
+                    result = future.result()
+                    error = None
+                except Exception as err:
+                    result = {}
+                    error = str(err)
+            result = {
+                'collisions': collisions,
+                'num_drones': num_drones,
+                'backend': args.backend,
+                **result,
+                'error': error,
+            }
+            results.append(result)
+            if error is None:
+                print(f'{collisions:10s} {num_drones:7d} {1e3 * result["mean"]:10.3f} {1e3 * result["p50"]:9.3f} {1e3 * result["p95"]:9.3f} {result["num_contacts"]:9d}')
+            else:
+                print(f'{collisions:10s} {num_drones:7d}   (failed: {error})')
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
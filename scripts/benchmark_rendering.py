@@ -0,0 +1,78 @@
+from argparse import ArgumentParser
+import concurrent.futures
+import multiprocessing
+import importlib
+import json
+import os
+import sys
+import time
+
+# Measures how many snapshots per second one of the simulators can take with
+# each renderer (see _get_renderer in the simulator), image size, and shadow
+# setting, without a display. For example:
+#
+#  python scripts/benchmark_rendering.py projects/04_drone ae353_drone
+
+def benchmark(directory, module_name, renderer, shadow, width, height, num_frames):
+    # This runs in its own process, because most simulators use the default
+    # physics client of pybullet
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    module = importlib.import_module(module_name)
+    simulator = module.Simulator(display=False, renderer=renderer, shadow=shadow)
+    simulator.reset()
+
+    # The first snapshot loads the renderer, so it is not timed
+    simulator.snapshot(width, height)
+    start_time = time.perf_counter()
+    for i in range(num_frames):
+        simulator.snapshot(width, height)
+    elapsed_time = time.perf_counter() - start_time
+    return simulator.renderer, num_frames / elapsed_time
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('directory', help='directory with the simulator (e.g., projects/04_drone)')
+    parser.add_argument('module', help='name of the simulator module (e.g., ae353_drone)')
+    parser.add_argument('--renderers', default='tiny,egl', help='comma-separated list of renderers')
+    parser.add_argument('--sizes', default='320x240,640x480,1280x960', help='comma-separated list of image sizes')
+    parser.add_argument('--frames', type=int, default=20, help='number of snapshots to time for each mode')
+    parser.add_argument('--json', metavar='outfile.json', default=None, help='file to which results are saved')
+    args = parser.parse_args()
+
+    directory = os.path.abspath(args.directory)
+    sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes.split(',')]
+    results = []
+    context = multiprocessing.get_context('spawn')
+    print(f'{"renderer":10s} {"size":>10s} {"shadow":>7s} {"frames/sec":>11s}')
+    for renderer in args.renderers.split(','):
+        for (width, height) in sizes:
+            for shadow in [True, False]:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    future = executor.submit(benchmark, directory, args.module, renderer, shadow, width, height, args.frames)
+                    try:
+                        name, fps = future.result()
+                        error = None
+                    except Exception as err:
+                        name, fps = renderer, None
+                        error = str(err)
+                result = {
+                    'renderer': name,
+                    'width': width,
+                    'height': height,
+                    'shadow': shadow,
+                    'fps': fps,
+                    'error': error,
+                }
+                results.append(result)
+                if error is None:
+                    print(f'{name:10s} {f"{width}x{height}":>10s} {str(shadow):>7s} {fps:11.1f}')
+                else:
+                    print(f'{name:10s} {f"{width}x{height}":>10s} {str(shadow):>7s}   (failed: {error})')
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
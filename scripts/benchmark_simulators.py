@@ -0,0 +1,223 @@
+from argparse import ArgumentParser
+import concurrent.futures
+import multiprocessing
+import importlib
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import numpy as np
+from benchmark_collisions import Controller
+
+# Measures how fast each simulator runs without a display - steps per
+# second, time per step, and peak memory use - and (optionally) compares the
+# results to those of an earlier run, so that changes that slow down batch
+# grading are found. For example:
+#
+#  python scripts/benchmark_simulators.py --json baseline.json
+#  (make changes)
+#  python scripts/benchmark_simulators.py --baseline baseline.json
+#
+# The exit code is 1 if any case is slower (or uses more memory) than its
+# baseline by more than the tolerance.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name, directory (from the root of the repository), module, and number of
+# outputs from the run method of each controller
+CASES = [
+    ('wheel', 'examples/day01', 'ae353_wheel', 1),
+    ('platform', 'projects/00_example/code', 'ae353_platform', 1),
+    ('platform_sensors', 'examples/day23/Platform', 'ae353_platform_sensors', 1),
+    ('platform_nonlinearsensors', 'examples/day25', 'ae353_platform_nonlinearsensors', 1),
+    ('cmg', 'projects/01_cmg', 'ae353_cmg', 1),
+    ('segbot', 'projects/02_segbot', 'ae353_segbot', 2),
+    ('spacecraft', 'projects/03_spacecraft', 'ae353_spacecraft', 4),
+]
+DRONE_DIRECTORY = 'projects/04_drone'
+
+class ZeroController:
+    # Does (almost) no work, so only the simulator is timed
+    def __init__(self, num_outputs):
+        self.num_outputs = num_outputs
+
+    def run(self, *args):
+        if self.num_outputs == 1:
+            return 0.
+        return (0.,) * self.num_outputs
+
+class HoverController(Controller):
+    # Hovers one meter above where it starts, rather than flying to the same
+    # point as every other drone
+    def reset(self, p_x_meas, p_y_meas, p_z_meas, yaw_meas):
+        super().reset(p_x_meas, p_y_meas, p_z_meas, yaw_meas)
+        self.p_goal = np.array([p_x_meas, p_y_meas, 1.])
+
+def get_peak_rss():
+    # Peak memory use of this process (MB), or None if it is not known
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss / 2**20
+    return peak_rss / 2**10
+
+def benchmark(directory, module_name, num_outputs, num_drones, max_time):
+    # This runs in its own process, because most simulators use the default
+    # physics client of pybullet, and so that peak memory use is per case
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    module = importlib.import_module(module_name)
+
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator = module.Simulator(display=False, seed=0)
+        if num_drones is None:
+            controller = ZeroController(num_outputs)
+            args = (controller, )
+        else:
+            simulator.set_rules(error_on_print=False, error_on_timeout=False)
+            # with many drones, some start inside the start ring and crash -
+            # they are kept running so the amount of work per step is the
+            # same from one version of the simulator to the next (versions
+            # before set_crash_detection was added never turn drones off)
+            if hasattr(simulator, 'set_crash_detection'):
+                simulator.set_crash_detection(None, None, None)
+            for i in range(num_drones):
+                simulator.add_drone(HoverController, f'drone_{i}', None)
+            args = ()
+        simulator.reset()
+    setup_time = time.perf_counter() - start_time
+
+    # Time each step that is taken by run
+    step_times = []
+    step = simulator.step
+    def timed_step(*args, **kwargs):
+        start_time = time.perf_counter()
+        result = step(*args, **kwargs)
+        step_times.append(time.perf_counter() - start_time)
+        return result
+    simulator.step = timed_step
+
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator.run(*args, max_time=max_time)
+    run_time = time.perf_counter() - start_time
+    step_times = np.array(step_times)
+
+    return {
+        'num_steps': len(step_times),
+        'steps_per_sec': len(step_times) / run_time,
+        'p50': float(np.percentile(step_times, 50)),
+        'p90': float(np.percentile(step_times, 90)),
+        'p99': float(np.percentile(step_times, 99)),
+        'max': float(np.max(step_times)),
+        'setup_time': setup_time,
+        'peak_rss_mb': get_peak_rss(),
+    }
+
+def compare(results, baseline, tolerance):
+    # Returns the names of cases that are slower (in steps per second) or use
+    # more memory (peak RSS) than their baseline by more than tolerance (a
+    # fraction), or that failed
+    baseline = {result['case']: result for result in baseline}
+    regressions = []
+    print(f'\n{"case":26s} {"steps/sec":>10s} {"baseline":>10s} {"ratio":>6s} {"rss (MB)":>9s} {"baseline":>9s}')
+    for result in results:
+        base = baseline.get(result['case'])
+        if (base is None) or (base['error'] is not None):
+            print(f'{result["case"]:26s}   (no baseline)')
+            continue
+        if result['error'] is not None:
+            print(f'{result["case"]:26s}   (failed)')
+            regressions.append(result['case'])
+            continue
+        ratio = result['steps_per_sec'] / base['steps_per_sec']
+        is_slower = (ratio < 1. - tolerance)
+        is_bigger = (
+            (result['peak_rss_mb'] is not None)
+            and (base['peak_rss_mb'] is not None)
+            and (result['peak_rss_mb'] > (1. + tolerance) * base['peak_rss_mb'])
+        )
+        rss = '' if result['peak_rss_mb'] is None else f'{result["peak_rss_mb"]:9.1f}'
+        base_rss = '' if base['peak_rss_mb'] is None else f'{base["peak_rss_mb"]:9.1f}'
+        flag = '  <-- REGRESSION' if (is_slower or is_bigger) else ''
+        print(f'{result["case"]:26s} {result["steps_per_sec"]:10.1f} {base["steps_per_sec"]:10.1f} {ratio:6.2f} {rss:>9s} {base_rss:>9s}{flag}')
+        if is_slower or is_bigger:
+            regressions.append(result['case'])
+    return regressions
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--cases', default=None, help='comma-separated list of cases (default is all of them)')
+    parser.add_argument('--drones', default='1,10,40,150', help='comma-separated list of numbers of drones')
+    parser.add_argument('--max-time', type=float, default=5., help='simulated time (in seconds) for each case')
+    parser.add_argument('--repeats', type=int, default=3, help='number of times to run each case (the fastest run is kept)')
+    parser.add_argument('--json', metavar='outfile.json', default=None, help='file to which results are saved')
+    parser.add_argument('--baseline', metavar='baseline.json', default=None, help='file with results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fraction by which a case can be slower than baseline')
+    args = parser.parse_args()
+
+    cases = [(name, directory, module, num_outputs, None) for (name, directory, module, num_outputs) in CASES]
+    for num_drones in [int(n) for n in args.drones.split(',')]:
+        cases.append((f'drone_{num_drones}', DRONE_DIRECTORY, 'ae353_drone', 4, num_drones))
+    if args.cases is not None:
+        names = args.cases.split(',')
+        unknown = set(names) - set(case[0] for case in cases)
+        if len(unknown) > 0:
+            raise Exception(f'unknown cases: {", ".join(sorted(unknown))}')
+        cases = [case for case in cases if case[0] in names]
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    print(f'{"case":26s} {"steps/sec":>10s} {"p50 (ms)":>9s} {"p90 (ms)":>9s} {"p99 (ms)":>9s} {"max (ms)":>9s} {"rss (MB)":>9s}')
+    for (name, directory, module, num_outputs, num_drones) in cases:
+        # Keep the fastest of several runs, which is the least affected by
+        # whatever else the computer is doing
+        result = {}
+        error = None
+        for i in range(args.repeats):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                future = executor.submit(benchmark, os.path.join(ROOT, directory), module, num_outputs, num_drones, args.max_time)
+                try:
+                    run_result = future.result()
+                except Exception as err:
+                    result = {}
+                    error = str(err)
+                    break
+            if (len(result) == 0) or (run_result['steps_per_sec'] > result['steps_per_sec']):
+                result = run_result
+        result = {
+            'case': name,
+            'module': module,
+            'num_drones': num_drones,
+            'max_time': args.max_time,
+            **result,
+            'error': error,
+        }
+        results.append(result)
+        if error is None:
+            rss = '' if result['peak_rss_mb'] is None else f'{result["peak_rss_mb"]:9.1f}'
+            print(f'{name:26s} {result["steps_per_sec"]:10.1f} {1e3 * result["p50"]:9.3f} {1e3 * result["p90"]:9.3f} {1e3 * result["p99"]:9.3f} {1e3 * result["max"]:9.3f} {rss:>9s}')
+        else:
+            print(f'{name:26s}   (failed: {error})')
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f'\n{len(regressions)} of {len(results)} cases regressed by more than {100 * args.tolerance:.0f}%: {", ".join(regressions)}')
+            sys.exit(1)
+        print(f'\nNo case regressed by more than {100 * args.tolerance:.0f}%')
+
+if __name__ == '__main__':
+    main()